@@ -6,13 +6,16 @@ This file is part of Ludolph.
 See the LICENSE file for copying permission.
 """
 
+import re
 import ssl
 import time
 import copy
 import logging
+from collections import namedtuple
 from datetime import datetime
+from functools import partial
 from sleekxmpp import ClientXMPP
-from sleekxmpp.xmlstream import ET
+from sleekxmpp.xmlstream import ET, ElementBase
 from sleekxmpp.exceptions import IqError
 from sleekxmpp.jid import JID
 
@@ -22,17 +25,30 @@ except ImportError:
     # noinspection PyUnresolvedReferences,PyPackageRequirements
     from ordereddict import OrderedDict
 
-from ludolph.message import IncomingLudolphMessage, OutgoingLudolphMessage
-from ludolph.command import COMMANDS
+from ludolph.message import IncomingLudolphMessage, OutgoingLudolphMessage, StanzaView, split_markup
+from ludolph.command import COMMANDS, Commands, PERM_USER, PERM_ADMIN, PERM_ROOM_USER, PERM_ROOM_ADMIN, PERM_ALL
 from ludolph.db import LudolphDB, LudolphDBMixin
 from ludolph.web import WebServer
 from ludolph.cron import Cron
-from ludolph.utils import catch_exception
+from ludolph.dispatcher import Dispatcher
+from ludolph.outbox import SendQueue, Aggregator
+from ludolph.ratelimit import TokenBucket, RateLimiter
+from ludolph.utils import catch_exception, LRUCache, PatternMatcher
 
 logger = logging.getLogger(__name__)
 
 __all__ = ('LudolphBot',)
 
+XHTML_IM_FEATURE = 'http://jabber.org/protocol/xhtml-im'
+MULTICAST_FEATURE = 'http://jabber.org/protocol/address'
+MORE_OUTPUT_SUFFIX = '\n... (type **more** to see the next part)'
+TRUNCATED_OUTPUT_SUFFIX = '\n... (output truncated)'
+BLOB_SUMMARY_LINES = 10
+BLOB_SUMMARY_SIZE = 1000
+
+EventHandler = namedtuple('EventHandler', ('fun', 'mutable', 'pattern'))
+MESSAGE_EVENTS = frozenset(['bot_message', 'muc_message'])
+
 
 class Plugins(OrderedDict):
     """
@@ -93,6 +109,7 @@ class LudolphBot(LudolphDBMixin):
     """
     _start_time = None
     _muc_ready = False
+    _room_state = None  # Room settings and member list applied during the last room configuration
     _reloaded = False
     reloading = False
     shutting_down = False
@@ -114,25 +131,45 @@ class LudolphBot(LudolphDBMixin):
     maxhistory = '16'
     webserver = None
     cron = None
+    dispatcher = None
+    outbox = None
+    aggregator = None
+    ratelimit = None
+    message_max_size = 0  # Maximum length of message text (0 = unlimited)
+    more_output_ttl = 3600
+    blob_threshold = 0  # Command outputs longer than this are served by the web server (0 = disabled)
+    blob_url = None
+    blob_once = True  # Links sent in private messages can be used only once
+    multicast = True  # Use XEP-0033 multicast for messages with multiple recipients (if supported by server)
+    multicast_max_recipients = 50  # Maximum number of addresses in one multicast stanza (0 = unlimited)
+    multicast_service = None
+    _jid_permissions = ({}, PERM_ALL)  # JID -> permission bitmask mapping and default permissions
     persistent_attrs = ('room_users_invited', 'room_users_last_seen')
 
     def __init__(self, config, plugins=None):
         super(LudolphBot, self).__init__()
 
         self._event_handlers = {
-            'bot_message': [self._run_command],
-            'bot_command_not_found': [self._command_not_found],
+            'bot_message': [EventHandler(self._run_command, True, None)],
+            'bot_command_not_found': [EventHandler(self._command_not_found, True, None)],
             'muc_message': [],
             'muc_user_online': [],
             'muc_user_offline': [],
         }
+        self._event_matchers = {}  # event name: (PatternMatcher, handler indexes) for events with pattern handlers
         self.users = set()
         self.admins = set()
         self.broadcast_blacklist = set()
+        self._broadcast_recipients = None  # Cached list of JIDs used by msg_broadcast()
         self.room_users = set()
         self.room_admins = set()
         self.room_users_invited = set()
         self.room_users_last_seen = {}
+        self._xhtml_support = {}  # bare JID: {resource: key of _xhtml_features}
+        self._xhtml_features = {}  # caps ver (or full JID of clients without caps): XHTML-IM support (None = unknown)
+        self._room_occupants = {}  # bare JID: [nicks] of room occupants
+        self.more_output = LRUCache(0)  # user: remaining parts of a split command output
+        self.multicast_stats = {'stanzas': 0, 'recipients': 0, 'saved_stanzas': 0, 'saved_bytes': 0}
 
         self._load_config(config, init=True)
         logger.info('Initializing jabber bot *%s*', self.nick)
@@ -146,12 +183,14 @@ class LudolphBot(LudolphDBMixin):
 
         # Register XMPP plugins
         client.register_plugin('xep_0030')  # Service Discovery
+        client.register_plugin('xep_0033')  # Extended Stanza Addressing
         client.register_plugin('xep_0045')  # Multi-User Chat
         client.register_plugin('xep_0071')  # XHTML-IM
         client.register_plugin('xep_0198')  # Stream Management
         client.register_plugin('xep_0199')  # XMPP Ping
         client.register_plugin('xep_0203')  # Delayed Delivery
         client.register_plugin('xep_0084')  # User Avatar
+        client.register_plugin('xep_0115')  # Entity Capabilities
         client.register_plugin('xep_0153')  # User Avatar vCard
         client.register_plugin('xep_0224')  # Attention
 
@@ -161,18 +200,35 @@ class LudolphBot(LudolphDBMixin):
         # Register event handlers
         client.add_event_handler('roster_subscription_request', self._handle_new_subscription)
         client.add_event_handler('session_start', self._session_start)
-        client.add_event_handler('message', self._bot_message, threaded=True)
-        client.add_event_handler('attention', self.handle_attention, threaded=True)
+        # The got_online/got_offline events are fired only for the first/last resource of a contact
+        client.add_event_handler('presence_available', self._discover_xhtml_support)
+        client.add_event_handler('presence_unavailable', self._forget_xhtml_support)
+        client.add_event_handler('roster_update', self._reset_broadcast_recipients)
+        client.add_event_handler('changed_subscription', self._reset_broadcast_recipients)
+        self._add_inbound_event_handler('message', self._bot_message, prioritized=True)
+        self._add_inbound_event_handler('attention', self.handle_attention)
 
         if self.room:
             self.muc = client.plugin['xep_0045']
-            client.add_event_handler('groupchat_message', self._muc_message, threaded=True)
-            client.add_event_handler('muc::%s::got_online' % self.room, self._muc_user_online, threaded=True)
-            client.add_event_handler('muc::%s::got_offline' % self.room, self._muc_user_offline, threaded=True)
+            self._add_inbound_event_handler('groupchat_message', self._muc_message, prioritized=True)
+            # The room occupant index is updated synchronously (in the event thread) before the presence is
+            # dispatched to other handlers (SleekXMPP runs event handlers in the order of registration)
+            client.add_event_handler('muc::%s::got_online' % self.room, self._index_room_occupant)
+            client.add_event_handler('muc::%s::got_offline' % self.room, self._unindex_room_occupant)
+            self._add_inbound_event_handler('muc::%s::got_online' % self.room, self._muc_user_online)
+            self._add_inbound_event_handler('muc::%s::got_offline' % self.room, self._muc_user_offline)
 
         # Run post initialization methods for all plugins
         self._post_init_plugins()
 
+        # Start the worker threads for processing inbound stanzas
+        if self.dispatcher:
+            self.dispatcher.start()
+
+        # Start the sender thread for processing outbound stanzas
+        if self.outbox:
+            self.outbox.start()
+
         # Start the web server thread for processing HTTP requests
         if self.webserver:
             # noinspection PyProtectedMember
@@ -294,6 +350,75 @@ class LudolphBot(LudolphDBMixin):
         if nick:
             self.nick = nick  # Warning: do not change the nick during runtime after this
 
+        # Command output cache
+        if config.has_option('global', 'command_cache_size'):
+            self.commands.results.max_size = config.getint('global', 'command_cache_size')
+        else:
+            self.commands.results.max_size = self.commands.results_cache_size
+
+        # Rendered messages cache
+        if config.has_option('global', 'message_cache') and not config.getboolean('global', 'message_cache'):
+            OutgoingLudolphMessage.render_cache.max_size = 0
+            OutgoingLudolphMessage.render_cache.clear()
+        elif config.has_option('global', 'message_cache_size'):
+            OutgoingLudolphMessage.render_cache.max_size = config.getint('global', 'message_cache_size')
+        else:
+            OutgoingLudolphMessage.render_cache.max_size = OutgoingLudolphMessage.render_cache_size
+
+        # Splitting of large messages
+        if config.has_option('global', 'message_max_size'):
+            self.message_max_size = config.getint('global', 'message_max_size')
+        else:
+            self.message_max_size = LudolphBot.message_max_size
+
+        if config.has_option('global', 'message_more_size'):
+            self.more_output.max_size = config.getint('global', 'message_more_size')
+        else:
+            self.more_output.max_size = 1048576
+
+        if config.has_option('global', 'message_more_ttl'):
+            self.more_output_ttl = config.getint('global', 'message_more_ttl')
+        else:
+            self.more_output_ttl = LudolphBot.more_output_ttl
+
+        # Default command timeout
+        if config.has_option('global', 'command_timeout') and config.get('global', 'command_timeout').strip():
+            self.commands.default_timeout = config.getfloat('global', 'command_timeout')
+        else:
+            self.commands.default_timeout = None
+
+        # Batching of stream_output command lines
+        for option, get in (('stream_flush_interval', config.getfloat), ('stream_flush_lines', config.getint),
+                            ('stream_flush_bytes', config.getint)):
+            if config.has_option('global', option):
+                setattr(self.commands, option, get('global', option))
+            else:
+                setattr(self.commands, option, getattr(Commands, option))
+
+        # Command rate limits
+        limits = {}
+
+        for kind in ('user', 'command', 'room'):
+            option = 'ratelimit_' + kind
+
+            if config.has_option('global', option):
+                value = config.get('global', option).strip()
+
+                if value:
+                    try:
+                        limits[kind] = TokenBucket.parse(value)
+                    except ValueError as e:
+                        logger.error('Skipping invalid setting "%s": %s', option, e)
+
+        if limits:
+            if config.has_option('global', 'ratelimit_reply'):
+                limits['reply'] = config.getboolean('global', 'ratelimit_reply')
+
+            self.ratelimit = RateLimiter(**limits)
+            logger.info('Command rate limits: %r', self.ratelimit)
+        else:
+            self.ratelimit = None
+
         # If you are working with an OpenFire server, you will
         # need to use a different SSL version:
         if config.has_option('xmpp', 'sslv3') and config.getboolean('xmpp', 'sslv3'):
@@ -314,6 +439,18 @@ class LudolphBot(LudolphDBMixin):
         self.broadcast_blacklist.clear()
         self.broadcast_blacklist.update(self.read_jid_array(xmpp_config, 'broadcast_blacklist', admins=self.admins))
         logger.info('Broadcast blacklist: %s', ', '.join(self.broadcast_blacklist))
+        self._broadcast_recipients = None
+
+        # XEP-0033 multicast
+        if config.has_option('xmpp', 'multicast'):
+            self.multicast = config.getboolean('xmpp', 'multicast')
+        else:
+            self.multicast = LudolphBot.multicast
+
+        if config.has_option('xmpp', 'multicast_max_recipients'):
+            self.multicast_max_recipients = config.getint('xmpp', 'multicast_max_recipients')
+        else:
+            self.multicast_max_recipients = LudolphBot.multicast_max_recipients
 
         # Admins vs. users
         if not self.admins.issubset(self.users):
@@ -381,6 +518,9 @@ class LudolphBot(LudolphDBMixin):
         if self.room_users_invited:
             self.room_users_invited.intersection_update(self.room_users)
 
+        # Permissions table
+        self._load_jid_permissions()
+
         # Web server (any change in configuration requires restart)
         if init and not self.webserver:
             if config.has_option('webserver', 'host') and config.has_option('webserver', 'port'):
@@ -390,11 +530,120 @@ class LudolphBot(LudolphDBMixin):
                 if host and port:  # Enable server (will be started in __init__)
                     self.webserver = WebServer(host, port)
 
+        # Large command outputs served by the web server
+        if self.webserver and config.has_option('webserver', 'blob_threshold'):
+            self.blob_threshold = config.getint('webserver', 'blob_threshold')
+        else:
+            self.blob_threshold = LudolphBot.blob_threshold
+
+        if self.blob_threshold:
+            if config.has_option('webserver', 'blob_url') and config.get('webserver', 'blob_url').strip():
+                self.blob_url = config.get('webserver', 'blob_url').strip().rstrip('/')
+            else:
+                # The web server usually listens on a private address, which is not reachable by users
+                logger.error('The blob_threshold setting requires blob_url (public URL of the web server). '
+                             'Large command outputs will be sent over XMPP.')
+                self.blob_threshold = LudolphBot.blob_threshold
+                self.blob_url = None
+
+        if self.blob_threshold:
+            blobs = self.webserver.blobs
+
+            if config.has_option('webserver', 'blob_ttl'):
+                blobs.ttl = config.getint('webserver', 'blob_ttl')
+
+            if config.has_option('webserver', 'blob_memory'):
+                blobs.max_memory = config.getint('webserver', 'blob_memory')
+
+            if config.has_option('webserver', 'blob_once'):
+                self.blob_once = config.getboolean('webserver', 'blob_once')
+            else:
+                self.blob_once = LudolphBot.blob_once
+
+            logger.info('Command outputs longer than %d characters will be served from %s%s',
+                        self.blob_threshold, self.blob_url, blobs.path)
+
         # Cron (any change in configuration requires restart)
         if init and not self.cron:
             if config.has_option('cron', 'enabled') and config.getboolean('cron', 'enabled'):
                 self.cron = Cron(db=self.db)
 
+        # Dispatcher (any change in configuration requires restart)
+        if init and not self.dispatcher:
+            if config.has_option('global', 'workers'):
+                workers = config.getint('global', 'workers')
+
+                if workers > 0:  # Enable worker pool (will be started in __init__)
+                    if config.has_option('global', 'queue_size'):
+                        queue_size = config.getint('global', 'queue_size')
+                    else:
+                        queue_size = 0
+
+                    if config.has_option('global', 'queue_overflow'):
+                        overflow = config.get('global', 'queue_overflow').strip()
+                    else:
+                        overflow = 'drop_oldest'
+
+                    if overflow == 'block':  # No longer supported (would block the SleekXMPP event thread)
+                        logger.error('Unsupported queue_overflow setting "block". Using "drop_oldest".')
+                        overflow = 'drop_oldest'
+
+                    lanes = {}
+
+                    for lane in ('high', 'low'):
+                        option = 'workers_' + lane
+
+                        if config.has_option('global', option) and config.get('global', option).strip():
+                            lanes[lane] = config.getint('global', option)
+
+                    try:
+                        self.dispatcher = Dispatcher(workers, queue_size=queue_size, overflow=overflow, lanes=lanes)
+                    except ValueError as e:
+                        logger.error('Invalid dispatcher configuration (%s). Using one thread per stanza.', e)
+
+        # Send queue (any change in configuration requires restart)
+        if init and not self.outbox:
+            if config.has_option('global', 'send_rate') and config.get('global', 'send_rate').strip():
+                send_rate = config.getfloat('global', 'send_rate')
+            else:
+                send_rate = 0
+
+            if config.has_option('global', 'send_byte_rate') and config.get('global', 'send_byte_rate').strip():
+                send_byte_rate = config.getint('global', 'send_byte_rate')
+            else:
+                send_byte_rate = 0
+
+            if config.has_option('global', 'send_burst'):
+                send_burst = config.getint('global', 'send_burst')
+            else:
+                send_burst = 5
+
+            if send_rate > 0 or send_byte_rate > 0:  # Enable send queue (will be started in __init__)
+                self.outbox = SendQueue(rate=send_rate, byte_rate=send_byte_rate, burst=send_burst)
+
+        # Aggregation of webhook notifications
+        if config.has_option('global', 'aggregate_window') and config.get('global', 'aggregate_window').strip():
+            aggregate_window = config.getfloat('global', 'aggregate_window')
+        else:
+            aggregate_window = 0
+
+        if config.has_option('global', 'aggregate_max'):
+            aggregate_max = config.getint('global', 'aggregate_max')
+        else:
+            aggregate_max = 50
+
+        if aggregate_window > 0:
+            if self.aggregator:
+                self.aggregator.window = aggregate_window
+                self.aggregator.max_items = aggregate_max
+            else:
+                self.aggregator = Aggregator(self._msg_send_aggregated, window=aggregate_window,
+                                             max_items=aggregate_max)
+            logger.info('Notification aggregation: %r', self.aggregator)
+        elif self.aggregator:
+            self.aggregator.flush()
+            self.aggregator = None
+
         if self._reloaded:
             if self.cron and self.db is None:  # DB support was disabled during reload
                 self.cron.db_disable()
@@ -501,25 +750,101 @@ class LudolphBot(LudolphDBMixin):
         for modname, plugin in reversed(list(self.plugins.items())):  # ludolph.bot is part of plugins
             self._destroy_plugin(modname, plugin)
 
+    def _add_inbound_event_handler(self, event_name, fun, prioritized=False):
+        """
+        Register SleekXMPP event handler for inbound stanzas, which are processed by the dispatcher (if enabled).
+        Prioritized messages are dispatched into a lane according to the requested command priority.
+        """
+        if self.dispatcher:
+            if prioritized:
+                self.client.add_event_handler(event_name, partial(self._dispatch_message, fun))
+            else:
+                self.client.add_event_handler(event_name, partial(self.dispatcher.submit, fun))
+        else:
+            self.client.add_event_handler(event_name, fun, threaded=True)
+
+    def _dispatch_message(self, fun, msg):
+        """
+        Submit incoming message to the dispatcher lane according to the priority of the requested command.
+        """
+        body = msg['body']
+
+        if msg['type'] == 'groupchat':
+            nick = self.nick + ':'
+
+            if body.startswith(nick):
+                body = body[len(nick):]
+            else:
+                body = ''
+
+        try:
+            cmd = self.commands.get_command(body.split(None, 1)[0])
+        except IndexError:
+            cmd = None
+
+        if cmd:
+            priority = cmd.priority
+        else:
+            priority = self.dispatcher.default_lane
+
+        self.dispatcher.submit_to(priority, fun, msg)
+
     def _run_event_handlers(self, event_name, *args):
         """
         Run all event handlers when an event happens.
         """
-        for event_handler in self._event_handlers[event_name]:
-            event_handler(*(copy.copy(arg) for arg in args))
+        event_handlers = self._event_handlers[event_name]
+        matcher = self._event_matchers.get(event_name, None)
+
+        if matcher:  # Run pattern handlers only if their pattern matches the message body
+            pattern_matcher, indexes = matcher
+            matched = set(indexes[i] for i in pattern_matcher.match(args[0]['body']))
+            event_handlers = [h for i, h in enumerate(event_handlers) if h.pattern is None or i in matched]
+
+        if len(event_handlers) == 1:
+            # The only event handler owns the stanza (SleekXMPP passes a copy to us if there are multiple handlers)
+            event_handlers[0].fun(*args)
+        else:
+            # Shared stanzas are passed as read-only or copy-on-write views (copied on first modification)
+            for fun, mutable, _ in event_handlers:
+                fun(*(StanzaView(arg, mutable=mutable) if isinstance(arg, ElementBase) else arg for arg in args))
+
+    def _update_event_matcher(self, event_name):
+        """
+        Compile patterns of all event handlers into one matcher.
+        """
+        event_handlers = self._event_handlers[event_name]
+        indexes = [i for i, h in enumerate(event_handlers) if h.pattern is not None]
+
+        if indexes:
+            self._event_matchers[event_name] = (PatternMatcher([event_handlers[i].pattern for i in indexes]), indexes)
+        else:
+            self._event_matchers.pop(event_name, None)
 
-    def register_event_handler(self, event_name, fun, clear=False):
+    def register_event_handler(self, event_name, fun, clear=False, mutable=True, pattern=None):
         """
         Add a function into event handlers.
+        Handlers which do not modify the stanza (e.g. do not reply to a message) should be registered with
+        mutable=False - they will receive a read-only view of the stanza.
+        Handlers of message events registered with a pattern (regular expression) are called only for messages with
+        body matching the pattern.
         """
         event_handlers = self._event_handlers[event_name]
 
+        if pattern is not None:
+            if event_name not in MESSAGE_EVENTS:
+                raise ValueError('Event "%s" does not support patterns' % event_name)
+
+            if not hasattr(pattern, 'search'):
+                pattern = re.compile(pattern)
+
         if clear:
             logger.info('Event [%s]: Removing all event handlers', event_name)
             del event_handlers[:]
 
         logger.info('Event [%s]: Adding event handler "%s"', event_name, fun)
-        event_handlers.append(fun)
+        event_handlers.append(EventHandler(fun, mutable, pattern))
+        self._update_event_matcher(event_name)
         logger.debug('Event [%s]: Current event handlers: %s', event_name, event_handlers)
 
     def deregister_event_handler(self, event_name, fun):
@@ -528,20 +853,26 @@ class LudolphBot(LudolphDBMixin):
         """
         event_handlers = self._event_handlers[event_name]
 
-        if fun not in event_handlers:
+        if not any(i.fun == fun for i in event_handlers):
             logger.warning('Event [%s]: Event handler "%s is not registered', event_name, fun)
             return
 
         logger.info('Event [%s]: Removing event handler "%s"', event_name, fun)
-        self._event_handlers[event_name] = [i for i in event_handlers if i != fun]
+        self._event_handlers[event_name] = [i for i in event_handlers if i.fun != fun]
+        self._update_event_matcher(event_name)
         logger.debug('Event [%s]: Current event handlers: %s', event_name, event_handlers)
 
-    def _room_members(self):
+    def _room_settings(self):
         """
-        Change multi-user chat room member list.
+        Return room related settings, which require rejoining and reconfiguring the room when changed.
         """
-        query = ET.Element('{http://jabber.org/protocol/muc#admin}query')
-        qitem = '{http://jabber.org/protocol/muc#admin}item'
+        return self.room, self.nick, self.maxhistory, bool(self.room_users)
+
+    def _room_member_items(self):
+        """
+        Return multi-user chat room member list items (JID: item attributes) according to current configuration.
+        """
+        items = OrderedDict()
         bot_member = {'jid': self.boundjid.bare}
 
         if self.room_bot_affiliation:
@@ -550,7 +881,7 @@ class LudolphBot(LudolphDBMixin):
         if self.room_bot_role:
             bot_member['role'] = self.room_bot_role
 
-        query.append(ET.Element(qitem, bot_member))
+        items[bot_member['jid']] = bot_member
 
         for jid in self.room_users:
             room_member = {'jid': jid}
@@ -569,7 +900,22 @@ class LudolphBot(LudolphDBMixin):
             if role:
                 room_member['role'] = role
 
-            query.append(ET.Element(qitem, room_member))
+            items[jid] = room_member
+
+        return items
+
+    def _room_members(self, items=None):
+        """
+        Change multi-user chat room member list (all members by default).
+        """
+        if items is None:
+            items = self._room_member_items()
+
+        query = ET.Element('{http://jabber.org/protocol/muc#admin}query')
+        qitem = '{http://jabber.org/protocol/muc#admin}item'
+
+        for item in items.values():
+            query.append(ET.Element(qitem, item))
 
         iq = self.client.make_iq_set(query)
         iq['to'] = self.room
@@ -605,11 +951,49 @@ class LudolphBot(LudolphDBMixin):
                          e.text, e.condition, e.etype)
 
         logger.info('Setting member list for MUC room %s', self.room)
+        items = self._room_member_items()
+
         try:
-            self._room_members()
+            self._room_members(items)
         except IqError as e:
             logger.error('Could not configure MUC room member list. Error was: %s (condition=%s, etype=%s)',
                          e.text, e.condition, e.etype)
+        else:
+            self._room_state = (self._room_settings(), items)
+
+    def _room_update_members(self):
+        """
+        Apply only changed member list items (removed members get the "none" affiliation).
+        Return False if the room must be rejoined and reconfigured because of other changes.
+        """
+        if not self._muc_ready or self._room_state is None:
+            return False
+
+        settings, old_items = self._room_state
+
+        if settings != self._room_settings():
+            return False
+
+        new_items = self._room_member_items()
+        changed = OrderedDict((jid, item) for jid, item in new_items.items() if old_items.get(jid, None) != item)
+
+        for jid in old_items:
+            if jid not in new_items:
+                changed[jid] = {'jid': jid, 'affiliation': 'none'}
+
+        if changed:
+            logger.info('Updating member list for MUC room %s: %s', self.room, ', '.join(changed))
+
+            try:
+                self._room_members(changed)
+            except IqError as e:
+                logger.error('Could not update MUC room member list. Error was: %s (condition=%s, etype=%s)',
+                             e.text, e.condition, e.etype)
+                return True
+
+        self._room_state = (settings, new_items)
+
+        return True
 
     @staticmethod
     def _sleekxmpp_fix_jid(jid):
@@ -624,14 +1008,61 @@ class LudolphBot(LudolphDBMixin):
         else:
             return JID(jid)
 
+    def _rebuild_room_occupants(self):
+        """
+        Create the bare JID -> nicks index of room occupants from the MUC plugin's room roster.
+        """
+        occupants = {}
+
+        for nick, entry in tuple(self.muc.rooms.get(self.room, {}).items()):  # Copy for python 3
+            if entry is not None:
+                jid = self._sleekxmpp_fix_jid(entry['jid']).bare
+
+                if jid:
+                    occupants.setdefault(jid, []).append(nick)
+
+        self._room_occupants = occupants
+
+    def _index_room_occupant(self, presence):
+        """
+        Add room occupant into the room occupant index (got_online event handler).
+        The index is rebuilt when we join the room.
+        """
+        if presence['from'] == self.room_jid:
+            self._rebuild_room_occupants()
+            return
+
+        muc = presence['muc']
+        jid = self._sleekxmpp_fix_jid(muc['jid']).bare
+
+        if jid:
+            nicks = self._room_occupants.setdefault(jid, [])
+
+            if muc['nick'] not in nicks:
+                nicks.append(muc['nick'])
+
+    def _unindex_room_occupant(self, presence):
+        """
+        Remove room occupant from the room occupant index (got_offline event handler).
+        """
+        muc = presence['muc']
+        jid = self._sleekxmpp_fix_jid(muc['jid']).bare
+        nicks = self._room_occupants.get(jid, ())
+
+        if muc['nick'] in nicks:
+            nicks.remove(muc['nick'])
+
+            if not nicks:
+                self._room_occupants.pop(jid, None)
+
     def _get_room_member(self, jid):
         """
         Return MUC room member object according to user's bare Jabber ID.
         """
-        for nick in self.muc.rooms[self.room]:
-            entry = self.muc.rooms[self.room][nick]
+        for nick in self._room_occupants.get(jid, ()):
+            entry = self.muc.rooms[self.room].get(nick, None)
 
-            if entry is not None and self._sleekxmpp_fix_jid(entry['jid']).bare == jid:
+            if entry is not None:
                 return entry
 
         raise KeyError('User with jabber ID "%s" is not listed on the room member list' % jid)
@@ -690,29 +1121,161 @@ class LudolphBot(LudolphDBMixin):
 
         return jid
 
+    def _load_jid_permissions(self):
+        """
+        Create new JID -> permission bitmask table from users, admins, room_users and room_admins settings.
+        An empty setting means that everybody has the permission.
+        """
+        settings = ((PERM_USER, self.users), (PERM_ADMIN, self.admins), (PERM_ROOM_USER, self.room_users),
+                    (PERM_ROOM_ADMIN, self.room_admins))
+        default = 0
+        table = {}
+
+        for perm, jids in settings:
+            if not jids:
+                default |= perm
+
+        for perm, jids in settings:
+            for jid in jids:
+                table[jid] = table.get(jid, default) | perm
+
+        self._jid_permissions = (table, default)  # The table is never modified after this point
+
+    def get_jid_permissions(self, jid):
+        """
+        Return permission bitmask (ludolph.command.PERM_*) of a bare JID (obtained by get_jid()).
+        """
+        table, default = self._jid_permissions
+
+        return table.get(jid, default)
+
     def is_jid_user(self, jid):
         """
         Return True if bare JID (obtained by get_jid()) is user or users are not set.
         """
-        return not self.users or jid in self.users
+        return bool(self.get_jid_permissions(jid) & PERM_USER)
 
     def is_jid_admin(self, jid):
         """
         Return True if bare JID (obtained by get_jid()) is admin or admins are not set.
         """
-        return not self.admins or jid in self.admins
+        return bool(self.get_jid_permissions(jid) & PERM_ADMIN)
 
     def is_jid_room_user(self, jid):
         """
         Return True if bare JID (obtained by get_jid()) is user or users are not set.
         """
-        return not self.room_users or jid in self.room_users
+        return bool(self.get_jid_permissions(jid) & PERM_ROOM_USER)
 
     def is_jid_room_admin(self, jid):
         """
         Return True if bare JID (obtained by get_jid()) is admin or admins are not set.
         """
-        return not self.room_admins or jid in self.room_admins
+        return bool(self.get_jid_permissions(jid) & PERM_ROOM_ADMIN)
+
+    def _discover_xhtml_support(self, presence):
+        """
+        Find out XHTML-IM support of a contact's resource, which sent an available presence. The result is cached
+        by the entity capabilities (XEP-0115) verification string, so a non-blocking service discovery request is
+        sent only for unknown client versions (or once for every resource of clients without entity capabilities).
+        """
+        jid = presence['from']
+
+        if not jid.resource or jid.bare in (self.boundjid.bare, self.room):
+            return
+
+        caps = presence['caps']
+        ver = caps['ver']
+
+        if ver:
+            key = ver
+            node = '%s#%s' % (caps['node'], ver)
+        else:
+            key = jid.full
+            node = None
+
+        resources = self._xhtml_support.setdefault(jid.bare, {})
+        old_key = resources.get(jid.resource, None)
+        resources[jid.resource] = key
+
+        if old_key == jid.full and old_key != key:  # The client started to use entity capabilities
+            self._xhtml_features.pop(old_key, None)
+
+        if key in self._xhtml_features:  # Known or discovery in progress
+            return
+
+        def callback(iq):
+            if iq['type'] == 'result':
+                supported = XHTML_IM_FEATURE in iq['disco_info']['features']
+                logger.debug('Contact "%s" (%s) XHTML-IM support: %s', jid.full, ver, supported)
+                self._xhtml_features[key] = supported
+            else:
+                self._xhtml_features.pop(key, None)  # Try again next time
+
+        self._xhtml_features[key] = None
+
+        try:
+            self.client.plugin['xep_0030'].get_info(jid=jid.full, node=node, block=False, callback=callback)
+        except Exception as exc:
+            self._xhtml_features.pop(key, None)
+            logger.warning('Could not discover XHTML-IM support of "%s": %s', jid.full, exc)
+
+    def _discover_multicast_support(self):
+        """
+        Ask our server about its XEP-0033 multicast support (non-blocking service discovery).
+        """
+        server = self.boundjid.domain
+        self.multicast_service = None
+
+        def callback(iq):
+            if iq['type'] == 'result' and MULTICAST_FEATURE in iq['disco_info']['features']:
+                logger.info('Server "%s" supports XEP-0033 multicast', server)
+                self.multicast_service = server
+
+        try:
+            self.client.plugin['xep_0030'].get_info(jid=server, block=False, callback=callback)
+        except Exception as exc:
+            logger.warning('Could not discover XEP-0033 multicast support of "%s": %s', server, exc)
+
+    def _forget_xhtml_support(self, presence):
+        """
+        Remove cached XHTML-IM support information of a contact's resource, which went offline.
+        """
+        jid = presence['from']
+        resources = self._xhtml_support.get(jid.bare)
+
+        if not resources:
+            return
+
+        key = resources.pop(jid.resource, None)
+
+        if not resources:
+            self._xhtml_support.pop(jid.bare, None)
+
+        if key == jid.full:  # Client without entity capabilities
+            self._xhtml_features.pop(key, None)
+
+    def is_jid_xhtml_capable(self, jid, mtype=None):
+        """
+        Return False if the message recipient is known to ignore XHTML-IM (XEP-0071).
+        Group chat messages and recipients with unknown capabilities get the html part.
+        """
+        if mtype == 'groupchat':
+            return True
+
+        jid = JID(jid)
+        resources = self._xhtml_support.get(jid.bare)
+
+        if not resources:
+            return True
+
+        features = self._xhtml_features
+
+        if jid.resource:
+            return features.get(resources.get(jid.resource)) is not False
+
+        # A message to a bare JID can be delivered to any of the available resources
+        return any(features.get(key) is not False for key in tuple(resources.values()))  # Copy for python 3
 
     @staticmethod
     def is_msg_delayed(msg):
@@ -746,6 +1309,7 @@ class LudolphBot(LudolphDBMixin):
         self.client.get_roster()
         self._roster_cleanup()
         self.client.send_presence(pnick=self.nick)
+        self._discover_multicast_support()
 
         if self.room and self.muc:
             logger.info('Initializing multi-user chat room %s', self.room)
@@ -790,6 +1354,30 @@ class LudolphBot(LudolphDBMixin):
         # Seek received text in available commands and get command
         cmd = self.commands.get_command(cmd_name)
 
+        # Check rate limits before running anything
+        if self.ratelimit:
+            user = self.get_jid(msg)
+
+            if msg['type'] == 'groupchat':
+                room = self.room
+            else:
+                room = None
+
+            # Unknown commands and unauthorized users spend only their own bucket, not the shared buckets
+            if cmd and cmd.is_jid_permitted_to_run(self, user):
+                exceeded = self.ratelimit.check(user, command=cmd.name, room=room)
+            else:
+                exceeded = self.ratelimit.check(user)
+
+            if exceeded:
+                logger.warning('Rate limit (%s) exceeded by user "%s" - ignoring command "%s"',
+                               exceeded, user, cmd_name)
+
+                if self.ratelimit.notify(user):
+                    self.msg_reply(msg, 'ERROR: Too many requests (%s limit exceeded). Please slow down.' % exceeded)
+
+                return
+
         if cmd:
             start_time = time.time()
             # Get and run command
@@ -861,29 +1449,7 @@ class LudolphBot(LudolphDBMixin):
             self.client.send_presence(pto=presence['from'], pnick=self.nick)
             self._muc_ready = True
             logger.info('People in MUC room: %s', ', '.join(self.muc.getRoster(self.room)))
-
-            # Reminder: We cannot use presence stanzas here because they are asynchronous
-            # Reminder: We cannot use roster information here, because roster may not be ready at this point and
-            #           roster_users != room_users
-            # Save last seen info and send invitation to all users; unless an invitation was sent in the past
-            for user in self.room_users:
-                if self.is_jid_in_room(user):
-                    logger.info('User "%s" already in MUC room', user)
-                    self._update_room_users_last_seen(user)
-                elif user != self.room:
-                    if user in self.room_users_last_seen:
-                        logger.info('User "%s" is not currently present in MUC room, but was last seen %s',
-                                    user, self.room_users_last_seen[user].isoformat())
-                    else:
-                        logger.info('User "%s" is not present in MUC room', user)
-
-                    if self.room_invites:
-                        if user in self.room_users_invited:
-                            logger.info('User "%s" was already invited to MUC room', user)
-                        else:
-                            logger.info('Inviting "%s" to MUC room', user)
-                            self.muc.invite(self.room, user)
-                            self.room_users_invited.add(user)
+            self._room_check_users()
 
         else:
             # Say hello to new user
@@ -894,6 +1460,33 @@ class LudolphBot(LudolphDBMixin):
             # Fire the muc_user_online event (nothing by default)
             self._run_event_handlers('muc_user_online', presence)
 
+    def _room_check_users(self):
+        """
+        Save last seen info of room users and send invitation to users, who are not in the room.
+        """
+        # Reminder: We cannot use presence stanzas here because they are asynchronous
+        # Reminder: We cannot use roster information here, because roster may not be ready at this point and
+        #           roster_users != room_users
+        # Save last seen info and send invitation to all users; unless an invitation was sent in the past
+        for user in self.room_users:
+            if self.is_jid_in_room(user):
+                logger.info('User "%s" already in MUC room', user)
+                self._update_room_users_last_seen(user)
+            elif user != self.room:
+                if user in self.room_users_last_seen:
+                    logger.info('User "%s" is not currently present in MUC room, but was last seen %s',
+                                user, self.room_users_last_seen[user].isoformat())
+                else:
+                    logger.info('User "%s" is not present in MUC room', user)
+
+                if self.room_invites:
+                    if user in self.room_users_invited:
+                        logger.info('User "%s" was already invited to MUC room', user)
+                    else:
+                        logger.info('Inviting "%s" to MUC room', user)
+                        self.muc.invite(self.room, user)
+                        self.room_users_invited.add(user)
+
     def _muc_user_offline(self, presence):
         """
         Process a offline presence stanza from a chat room.
@@ -925,6 +1518,7 @@ class LudolphBot(LudolphDBMixin):
         try:
             if self.webserver:
                 self.webserver.stop()
+                self.webserver.blobs.clear()
         except Exception as e:
             logger.exception(e)
             logger.error('Webserver shutdown failed')
@@ -936,6 +1530,19 @@ class LudolphBot(LudolphDBMixin):
             logger.exception(e)
             logger.error('Cron shutdown failed')
 
+        try:
+            if self.dispatcher:
+                self.dispatcher.stop()
+
+            if self.aggregator:
+                self.aggregator.flush()
+
+            if self.outbox:
+                self.outbox.stop()
+        except Exception as e:
+            logger.exception(e)
+            logger.error('Dispatcher shutdown failed')
+
         try:
             if self.db is not None:
                 self._db_set_items_all()  # all plugins (including ludolph.bot)
@@ -987,13 +1594,73 @@ class LudolphBot(LudolphDBMixin):
         self._load_plugins(config, plugins, init=False)
 
         if self.room and self.muc:
-            self._muc_ready = False
-            self.muc.leaveMUC(self.room, self.nick)
-            logger.info('Reinitializing multi-user chat room %s', self.room)
-            self.muc.joinMUC(self.room, self.nick, maxhistory=self.maxhistory)
+            if self._room_update_members():
+                logger.info('Configuration of multi-user chat room %s has not changed', self.room)
+                self._room_check_users()
+            else:
+                self._muc_ready = False
+                self._room_state = None
+                self._room_occupants = {}
+                self.muc.leaveMUC(self.room, self.nick)
+                logger.info('Reinitializing multi-user chat room %s', self.room)
+                self.muc.joinMUC(self.room, self.nick, maxhistory=self.maxhistory)
 
         self._post_init_plugins()
 
+    def display_stats(self):
+        """
+        Return list of runtime statistics suitable for logging (used by the metrics command).
+        """
+        out = []
+
+        if self.dispatcher:
+            out.append('Dispatcher:')
+            out.extend(self.dispatcher.display_stats())
+        else:
+            out.append('Dispatcher: disabled (one thread per stanza)')
+
+        if self.outbox:
+            out.append('Send queue: %s' % self.outbox.display_stats())
+        else:
+            out.append('Send queue: disabled')
+
+        if self.aggregator:
+            out.append('Notification aggregation: %s' % self.aggregator.display_stats())
+        else:
+            out.append('Notification aggregation: disabled')
+
+        if self.ratelimit:
+            out.append('Rate limits: %s' % self.ratelimit.display_stats())
+        else:
+            out.append('Rate limits: disabled')
+
+        out.append('Command cache: %s' % self.commands.results.display_stats())
+        out.append('Coalesced commands: %s' % self.commands.inflight.display_stats())
+
+        if self.multicast and self.multicast_service:
+            out.append('Multicast: service=%s stanzas=%d recipients=%d saved_stanzas=%d saved_bytes=%d' % (
+                self.multicast_service, self.multicast_stats['stanzas'], self.multicast_stats['recipients'],
+                self.multicast_stats['saved_stanzas'], self.multicast_stats['saved_bytes']))
+        else:
+            out.append('Multicast: disabled')
+
+        if self.message_max_size:
+            out.append('Output buffers (more): %s' % self.more_output.display_stats())
+        else:
+            out.append('Output buffers (more): disabled')
+
+        if self.blob_threshold:
+            out.append('Output blobs: %s' % self.webserver.blobs.display_stats())
+        else:
+            out.append('Output blobs: disabled')
+
+        if OutgoingLudolphMessage.render_cache.max_size:
+            out.append('Message cache: %s' % OutgoingLudolphMessage.render_cache.display_stats())
+        else:
+            out.append('Message cache: disabled')
+
+        return out
+
     @staticmethod
     def msg_copy(msg, **kwargs):
         """
@@ -1006,24 +1673,167 @@ class LudolphBot(LudolphDBMixin):
 
         return msg
 
+    def send_stanza(self, stanza, priority=False):
+        """
+        Send stanza through the send queue (if enabled). Priority is used for replies to commands.
+        """
+        if self.outbox:
+            return self.outbox.put(stanza, priority=priority)
+
+        return stanza.send()
+
+    def send_stanzas(self, stanzas, priority=False):
+        """
+        Send multiple stanzas at once through the send queue (if enabled).
+        """
+        if self.outbox:
+            return self.outbox.put_many(stanzas, priority=priority)
+
+        for stanza in stanzas:
+            stanza.send()
+
+        return True
+
     def msg_send(self, mto, mbody, mfrom=None, mnick=None, **kwargs):
         """
-        Create message and send it.
+        Create message and send it. Messages larger than message_max_size are split into multiple messages.
+        """
+        msg = OutgoingLudolphMessage.create(mbody, **kwargs)
+
+        if self.message_max_size:
+            res = None
+
+            for part in msg.split(self.message_max_size):
+                res = part.send(self, mto, mfrom=mfrom, mnick=mnick)
+
+            return res
+
+        return msg.send(self, mto, mfrom=mfrom, mnick=mnick)
+
+    def _msg_send_aggregated(self, key, mbody):
+        """
+        Send (aggregated) notification to destination identified by key - see msg_notify().
+        """
+        mto, mtype = key
+
+        if mto is None:
+            return self.msg_broadcast(mbody, mtype=mtype)
+        elif isinstance(mto, tuple):
+            return self.msg_send_many(mto, mbody, mtype=mtype)
+        else:
+            return self.msg_send(mto, mbody, mtype=mtype)
+
+    def msg_notify(self, mto, mbody, mtype='normal'):
+        """
+        Send notification (e.g. message from webhook) to JID, tuple of JIDs or to all users in roster (mto=None).
+        Notifications for the same destination are grouped into one digest message if aggregation is enabled.
+        """
+        key = (mto, mtype)
+
+        if self.aggregator:
+            return self.aggregator.add(key, mbody)
+
+        return self._msg_send_aggregated(key, mbody)
+
+    def _get_more_output_key(self, msg):
+        """
+        Return key of the more_output buffer for the sender of a message (bare JID or full JID if unknown).
+        """
+        return self.get_jid(msg) or str(msg['from'])
+
+    def _msg_paginate(self, user, msg):
+        """
+        Split large message into parts. Return the first part and save the rest into user's more_output buffer.
+        The buffer is replaced only by a message, which is split (short replies keep the previous buffer).
+        """
+        parts = msg.split(self.message_max_size, suffix=MORE_OUTPUT_SUFFIX)
+
+        if len(parts) == 1:
+            return msg
+
+        rest = parts[1:]
+
+        if self.more_output.set(user, rest, ttl=self.more_output_ttl, size=sum(len(i.text) for i in rest)):
+            logger.info('Message to "%s" was split into %d parts', user, len(parts))
+            return parts[0]
+
+        logger.warning('Message to "%s" is too large (%d parts) - truncating', user, len(parts))
+        self.more_output.delete(user)
+
+        return msg.split(self.message_max_size, suffix=TRUNCATED_OUTPUT_SUFFIX)[0]
+
+    def shorten_output(self, out, private=True):
+        """
+        Save command output longer than blob_threshold into the web server's blob store. Return a short summary with
+        a link to the full output. Other outputs are returned unchanged. Links sent to a chat room (private=False) are
+        shared by all occupants and can be used until they expire; other links are one-time if blob_once is enabled.
         """
-        return OutgoingLudolphMessage.create(mbody, **kwargs).send(self, mto, mfrom=mfrom, mnick=mnick)
+        if not self.blob_threshold or out is None:
+            return out
+
+        if isinstance(out, OutgoingLudolphMessage):
+            text = out.text or ''
+        else:
+            text = str(out)
+
+        if len(text) <= self.blob_threshold:
+            return out
+
+        blobs = self.webserver.blobs
+        token = blobs.add(text, once=private and self.blob_once)
+        url = self.blob_url + blobs.path + token
+        summary = split_markup('\n'.join(text.split('\n', BLOB_SUMMARY_LINES)[:BLOB_SUMMARY_LINES]),
+                               BLOB_SUMMARY_SIZE)[0]
+        logger.info('Command output (%d characters) was saved as blob %s', len(text), token)
+
+        return '%s\n... (%d lines, %d characters) [[%s|full output]]' % (summary, text.count('\n') + 1, len(text), url)
+
+    def msg_more(self, msg):
+        """
+        Return next part of a large message, which was split by msg_reply() for the sender of msg, or None.
+        """
+        user = self._get_more_output_key(msg)
+        parts = self.more_output.get(user)
+
+        if not parts:
+            return None
+
+        part, rest = parts[0], parts[1:]
+
+        if rest:
+            self.more_output.set(user, rest, ttl=self.more_output_ttl, size=sum(len(i.text) for i in rest))
+        else:
+            self.more_output.delete(user)
+
+        return part
 
     # noinspection PyMethodMayBeStatic
-    def msg_reply(self, msg, mbody, preserve_msg=False, **kwargs):
+    def msg_reply(self, msg, mbody, preserve_msg=False, paginate=True, **kwargs):
         """
-        Set message reply text and html, and send it.
+        Set message reply text and html, and send it. Replies larger than message_max_size are split into parts;
+        the first part is sent and the rest is available through the more command (or all parts are sent if
+        paginate is False).
         """
         if mbody is None:
             return None  # Command performs custom message sending
 
+        out = OutgoingLudolphMessage.create(mbody, **kwargs)
+
+        if self.message_max_size:
+            if paginate:
+                out = self._msg_paginate(self._get_more_output_key(msg), out)
+            else:
+                res = None
+
+                for part in out.split(self.message_max_size):
+                    res = part.reply(self.msg_copy(msg), xmpp=self)
+
+                return res
+
         if preserve_msg:
             msg = self.msg_copy(msg)
 
-        return OutgoingLudolphMessage.create(mbody, **kwargs).reply(msg)
+        return out.reply(msg, xmpp=self)
 
     def msg_resend(self, msg, **kwargs):
         """
@@ -1034,16 +1844,79 @@ class LudolphBot(LudolphDBMixin):
 
         return OutgoingLudolphMessage.create(msg['body'], **kwargs).send(self, msg['from'], mfrom=msg['to'])
 
+    # noinspection PyUnusedLocal
+    def _reset_broadcast_recipients(self, *args):
+        """
+        Invalidate the cached list of broadcast recipients (roster_update and changed_subscription event handler).
+        """
+        self._broadcast_recipients = None
+
+    def get_broadcast_recipients(self):
+        """
+        Return tuple of JIDs from roster, which are not blacklisted from receiving broadcast messages.
+        """
+        recipients = self._broadcast_recipients
+
+        if recipients is None:
+            own_jid = self.boundjid.bare
+            blacklist = self.broadcast_blacklist
+            recipients = tuple(jid for jid in tuple(self.client_roster)  # Copy for python 3
+                               if not (jid == own_jid or jid in blacklist))
+            self._broadcast_recipients = recipients
+
+        return recipients
+
+    def _msg_multicast(self, msg, recipients):
+        """
+        Send message to multiple recipients through the XEP-0033 multicast service.
+        """
+        stats = self.multicast_stats
+        stanzas = []
+
+        for stanza, jids in msg.multicast(self, self.multicast_service, recipients,
+                                          max_recipients=self.multicast_max_recipients):
+            size = len(str(stanza))
+            # Estimated size of one stanza sent directly to a recipient (without the addresses element)
+            single_size = size - len(str(stanza['addresses']))
+            stats['saved_stanzas'] += len(jids) - 1
+            stats['saved_bytes'] += single_size * len(jids) - size
+            stanzas.append(stanza)
+
+        stats['stanzas'] += len(stanzas)
+        stats['recipients'] += len(recipients)
+        logger.debug('Sending message to %d recipients in %d multicast stanza(s)', len(recipients), len(stanzas))
+
+        return self.send_stanzas(stanzas)
+
+    def msg_send_many(self, recipients, mbody, **kwargs):
+        """
+        Create message and send it to multiple recipients. XEP-0033 multicast is used if supported by our server,
+        otherwise the message is sent to every recipient separately.
+        """
+        msg = OutgoingLudolphMessage.create(mbody, **kwargs)
+
+        if self.message_max_size:
+            parts = msg.split(self.message_max_size)
+        else:
+            parts = (msg,)
+
+        res = None
+
+        for part in parts:
+            if self.multicast and self.multicast_service and len(recipients) > 1:
+                res = self._msg_multicast(part, recipients)
+            else:
+                res = self.send_stanzas(part.fan_out(self, recipients))
+
+        return res
+
     def msg_broadcast(self, mbody, **kwargs):
         """
         Send message to all users in roster.
         """
-        msg = OutgoingLudolphMessage.create(mbody, **kwargs)
-        i = 0
+        recipients = self.get_broadcast_recipients()
 
-        for jid in self.client_roster:
-            if not (jid == self.boundjid.bare or jid in self.broadcast_blacklist):
-                msg.send(self, jid)
-                i += 1
+        if recipients:
+            self.msg_send_many(recipients, mbody, **kwargs)
 
-        return i
+        return len(recipients)
@@ -8,10 +8,14 @@ See the LICENSE file for copying permission.
 from logging import getLogger
 from functools import wraps
 from collections import namedtuple
-import shlex
+from datetime import datetime, timedelta
+from threading import Timer, Lock
+import re
 import inspect
 
-__all__ = ('CommandError', 'PermissionDenied', 'MissingParameter', 'command')
+from ludolph.utils import LRUCache, SingleFlight, CancellationToken, catch_exception
+
+__all__ = ('CommandError', 'PermissionDenied', 'MissingParameter', 'AmbiguousCommand', 'CommandTimeout', 'command')
 
 logger = getLogger(__name__)
 
@@ -37,14 +41,205 @@ class MissingParameter(CommandError):
     error_message = 'Missing parameter'
 
 
+class CommandTimeout(CommandError):
+    error_message = 'Command timed out'
+
+
+class AmbiguousCommand(CommandError):
+    error_message = 'Ambiguous command'
+
+    def __init__(self, msg=None, matches=()):
+        super(AmbiguousCommand, self).__init__(msg=msg)
+        self.matches = matches
+
+    def __str__(self):
+        return 'ERROR: %s (%s)' % (self.error_message, ', '.join(self.matches))
+
+
 CommandPermissions = namedtuple('CommandPermissions', ('user_required', 'admin_required', 'room_user_required',
                                                        'room_admin_required'))
 
+# Permission bits (see LudolphBot.get_jid_permissions())
+PERM_USER = 1
+PERM_ADMIN = 2
+PERM_ROOM_USER = 4
+PERM_ROOM_ADMIN = 8
+PERM_ALL = PERM_USER | PERM_ADMIN | PERM_ROOM_USER | PERM_ROOM_ADMIN
+
+
+def get_permissions_mask(perms):
+    """Return permission bitmask required by CommandPermissions"""
+    mask = 0
+
+    for required, perm in zip(perms, (PERM_USER, PERM_ADMIN, PERM_ROOM_USER, PERM_ROOM_ADMIN)):
+        if required:
+            mask |= perm
+
+    return mask
+
+
 CommandParameters = namedtuple('CommandParameters', ('args_count', 'kwargs_count', 'star_args'))
 
+PRIORITIES = frozenset(['high', 'normal', 'low'])  # Dispatcher lanes
+
+
+def jid_type(value):
+    """Command parameter type: bare or full jabber ID"""
+    from sleekxmpp.jid import JID  # SleekXMPP is loaded by the bot
+    jid = JID(value)
+
+    if not jid.user:
+        raise ValueError('missing username')
+
+    return jid
+
+
+def datetime_type(value):
+    """Command parameter type: +minutes or Y-m-d-H-M"""
+    if value.startswith('+'):
+        return datetime.now() + timedelta(minutes=int(value))
+
+    return datetime.strptime(value, '%Y-%m-%d-%H-%M')
+
+
+PARAMETER_TYPES = {
+    'str': str,
+    'int': int,
+    'jid': jid_type,
+    'datetime': datetime_type,
+}
+
+
+class CommandParser(object):
+    """
+    Command parameters parser. Created for every command during command registration.
+
+    The message body is tokenized by a quote-aware scanner similar to shlex.split(), but only until all positional
+    parameters are found. The rest of the body is used unsplit as the last parameter (unless the function accepts
+    *args). Parameters can be converted by functions specified in the types mapping (parameter name -> callable).
+    """
+    _special_chars_rx = re.compile(r'[\\\'"]')
+    _token_rx = re.compile(r'(?:[^\s\\\'"]+|"(?:[^"\\]|\\.)*"|\'[^\']*\'|\\.)+', re.DOTALL)
+    _segment_rx = re.compile(r'([^\s\\\'"]+)|"((?:[^"\\]|\\.)*)"|\'([^\']*)\'|\\(.)', re.DOTALL)
+    _escape_rx = re.compile(r'\\([\\"])')
+
+    def __init__(self, fun_spec, names=(), star_name=None, types=None):
+        self.args_count = fun_spec.args_count
+        self.star_args = fun_spec.star_args
+        self.last_pos = fun_spec.args_count + fun_spec.kwargs_count - 1
+        self.converters = []
+        self.star_converter = None
+
+        if types:
+            for i, name in enumerate(names):
+                if name in types:
+                    self.converters.append((i, name, types[name]))
+
+            if star_name in types:
+                self.star_converter = (len(names), star_name, types[star_name])
+
+    def __repr__(self):
+        return '%s(args=%s, last_pos=%s, star_args=%s)' % (self.__class__.__name__, self.args_count, self.last_pos,
+                                                           self.star_args)
+
+    @classmethod
+    def _unquote(cls, token):
+        """Remove quotes and escape characters from token"""
+        out = []
+
+        for plain, double_quoted, single_quoted, escaped in cls._segment_rx.findall(token):
+            if double_quoted:
+                out.append(cls._escape_rx.sub(r'\1', double_quoted))
+            else:
+                out.append(plain or single_quoted or escaped)
+
+        return ''.join(out)
+
+    @classmethod
+    def tokenize(cls, text, maxsplit=-1):
+        """
+        Split text into a list of at most maxsplit+1 items. The last item is the unsplit rest of the text.
+        """
+        if not cls._special_chars_rx.search(text):  # Fast path
+            return text.split(None, maxsplit)
+
+        tokens = []
+        token_rx = cls._token_rx
+        pos = 0
+        end = len(text)
+
+        while pos < end:
+            while pos < end and text[pos].isspace():
+                pos += 1
+
+            if pos == end:
+                break
+
+            if len(tokens) == maxsplit:
+                tokens.append(text[pos:].rstrip())
+                break
+
+            match = token_rx.match(text, pos)
+
+            if not match:  # Unbalanced quotes or trailing escape character -> use the ordinary split
+                tokens.extend(text[pos:].split(None, maxsplit - len(tokens)))
+                break
+
+            tokens.append(cls._unquote(match.group()))
+            pos = match.end()
+
+        return tokens
+
+    def parse(self, body):
+        """Parse message body and return a list which can be used as *args parameter for the command"""
+        last_pos = self.last_pos
+
+        if last_pos < 0 and not self.star_args:  # Function has no custom arguments
+            return []
+
+        # Get command parameters (with command name removed)
+        if self.star_args:
+            params = self.tokenize(body)[1:]
+        else:
+            params = self.tokenize(body, maxsplit=last_pos + 1)[1:]
+
+            if len(params) > last_pos:
+                # The last parameter is used unsplit, but we don't want to keep quotes around a single parameter
+                tail = params[last_pos]
+                tail_tokens = self.tokenize(tail, maxsplit=1)
+
+                if len(tail_tokens) == 1:
+                    params[last_pos] = tail_tokens[0]
+
+        args_count = self.args_count
+
+        if args_count:  # Check if required arguments are set and not empty
+            if len(params) < args_count or not all(params[:args_count]):
+                raise MissingParameter
+
+        for i, name, converter in self.converters:
+            if i < len(params):
+                params[i] = self._convert(name, converter, params[i])
+
+        if self.star_converter:
+            start, name, converter = self.star_converter
+
+            for i in range(start, len(params)):
+                params[i] = self._convert(name, converter, params[i])
+
+        return params
+
+    @staticmethod
+    def _convert(name, converter, value):
+        try:
+            return converter(value)
+        except (ValueError, TypeError) as e:
+            raise CommandError('Invalid parameter __%s__: %s' % (name, e))
+
 
 # noinspection PyClassHasNoInit
-class Command(namedtuple('Command', ('name', 'fun_name', 'module', 'doc', 'perms', 'fun_spec'))):
+class Command(namedtuple('Command', ('name', 'fun_name', 'module', 'doc', 'perms', 'fun_spec', 'priority',
+                                     'parser', 'perms_mask'))):
     """
     Ludolph command wrapper.
     """
@@ -60,41 +255,117 @@ class Command(namedtuple('Command', ('name', 'fun_name', 'module', 'doc', 'perms
 
     def is_jid_permitted_to_run(self, xmpp, jid):
         """Return True if user is allowed to run the command"""
-        perms = self.perms
+        mask = self.perms_mask
 
-        for perm, check in ((perms.user_required, xmpp.is_jid_user),
-                            (perms.admin_required, xmpp.is_jid_admin),
-                            (perms.room_user_required, xmpp.is_jid_room_user),
-                            (perms.room_admin_required, xmpp.is_jid_room_admin)):
-            if perm and not check(jid):
-                return False
+        return xmpp.get_jid_permissions(jid) & mask == mask
 
-        return True
+    @staticmethod
+    def get_permission_class(xmpp, jid):
+        """Return bitmask representing all permissions of a user"""
+        return xmpp.get_jid_permissions(jid)
 
     def get_args_from_msg_body(self, body):
         """Parse message body and return a list which can be used as *args parameter for this command"""
-        fun_spec = self.fun_spec
-        last_pos = fun_spec.args_count + fun_spec.kwargs_count - 1
+        return self.parser.parse(body)
 
-        if last_pos < 0 and not fun_spec.star_args:  # Function has no custom arguments
-            return []
 
-        # Try to get command parameters (with command name removed)
-        try:
-            params = shlex.split(body)[1:]
-        except ValueError:
-            params = body.split()[1:]
+def _sizeof_output(out):
+    """Size of a command output (length of the source text) used by the command output cache"""
+    text = getattr(out, 'text', None)
 
-        params_count = len(params)
+    if text is None:
+        text = str(out)
 
-        if fun_spec.args_count:  # Check if required arguments are set and not empty
-            if params_count < fun_spec.args_count or not all(params[:fun_spec.args_count]):
-                raise MissingParameter
+    return len(text)
 
-        if fun_spec.star_args or last_pos >= params_count:
-            return params
-        else:
-            return params[:last_pos] + [' '.join(params[last_pos:])]
+
+class PrefixIndex(object):
+    """
+    Prefix tree (trie) of command names. Lookups are O(len(prefix)).
+    """
+    __slots__ = ('children', 'key')
+
+    def __init__(self, keys=()):
+        self.children = {}
+        self.key = None  # Set if a key ends in this node
+
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        node = self
+
+        for char in key:
+            try:
+                node = node.children[char]
+            except KeyError:
+                node.children[char] = node = PrefixIndex()
+
+        node.key = key
+
+    def remove(self, key):
+        path = []
+        node = self
+
+        for char in key:
+            try:
+                path.append((node, char))
+                node = node.children[char]
+            except KeyError:
+                return
+
+        node.key = None
+
+        # Remove empty nodes
+        for parent, char in reversed(path):
+            if node.key is None and not node.children:
+                del parent.children[char]
+                node = parent
+            else:
+                break
+
+    def _get_node(self, prefix):
+        node = self
+
+        for char in prefix:
+            try:
+                node = node.children[char]
+            except KeyError:
+                return None
+
+        return node
+
+    def first(self, prefix):
+        """Return first (sorted) key starting with prefix or None"""
+        node = self._get_node(prefix)
+
+        while node is not None:
+            if node.key is not None:
+                return node.key
+
+            if not node.children:
+                break
+
+            node = node.children[min(node.children)]
+
+        return None
+
+    def _keys(self):
+        if self.key is not None:
+            yield self.key
+
+        for char in sorted(self.children):
+            for key in self.children[char]._keys():
+                yield key
+
+    def find(self, prefix):
+        """Return sorted list of all keys starting with prefix"""
+        node = self._get_node(prefix)
+
+        if node is None:
+            return []
+
+        return list(node._keys())
 
 
 class Commands(dict):
@@ -102,6 +373,17 @@ class Commands(dict):
     Command names to (name, module, doc) mapping.
     """
     _cache = None  # Cached sorted list of commands
+    results_cache_size = 1048576  # Default size of the command output cache (characters)
+    default_timeout = None  # Default execution timeout of commands without the timeout option (seconds)
+    stream_flush_interval = 1.0  # Maximum time for which stream_output lines are buffered (seconds)
+    stream_flush_lines = 50  # Maximum number of buffered stream_output lines (1 = one message per line)
+    stream_flush_bytes = 4096  # Maximum size of buffered stream_output lines (bytes)
+
+    def __init__(self, *args, **kwargs):
+        super(Commands, self).__init__(*args, **kwargs)
+        self._index = PrefixIndex(self.keys())
+        self.results = LRUCache(self.results_cache_size, sizeof=_sizeof_output)  # Output of commands with cache_ttl
+        self.inflight = SingleFlight()  # Running commands with coalesce
 
     def pop(self, key, **kwargs):
         """Properly remove command from dict and cache"""
@@ -109,6 +391,8 @@ class Commands(dict):
 
         if cmd:
             logger.info('Deregistering command "%s" from plugin "%s"', cmd.name, cmd.module)
+            self._index.remove(key)
+
             if self._cache:
                 try:
                     self._cache.remove(key)
@@ -122,6 +406,7 @@ class Commands(dict):
         assert key == cmd.name
         logger.debug('Registering command "%s" from plugin "%s"', cmd.name, cmd.module)
         super(Commands, self).__setitem__(key, cmd)
+        self._index.add(key)
 
     def __delitem__(self, key):
         """Properly remove command from dict and cache"""
@@ -130,6 +415,11 @@ class Commands(dict):
         else:
             raise KeyError(key)
 
+    def clear(self):
+        super(Commands, self).clear()
+        self._index = PrefixIndex()
+        self._cache = None
+
     def reset(self, module=None):
         """Used before bot reload"""
         if module:
@@ -138,50 +428,188 @@ class Commands(dict):
                 if cmd.module == module:
                     logger.debug('Deregistering command "%s" from plugin "%s"', name, cmd.module)
                     del self[name]
+
+            self.results.invalidate(lambda key: key[0] == module)
         else:
             logger.info('Reinitializing commands')
             self.clear()
+            self.results.clear()
 
     def all(self, reset=False):
         """List of all available bot commands"""
         if self._cache is None or reset:
             self._cache = sorted(self.keys())
 
+            if reset:
+                self._index = PrefixIndex(self._cache)
+
         return self._cache
 
     def display(self):
         """Return list of available commands suitable for logging output"""
         return ['%s [%s]' % (name, cmd.module) for name, cmd in list(self.items())]
 
-    def get_command(self, cmdstr):
-        """Find text in available commands and return command tuple"""
+    def get_command(self, cmdstr, strict=False):
+        """
+        Find text in available commands and return command tuple. The first matching command is returned unless
+        strict is True - then AmbiguousCommand is raised in case the text matches more than one command.
+        """
         if not cmdstr:
             return None
 
         cmdstr = cmdstr.lower()
 
-        if cmdstr in self.all():
-            cmd = self[cmdstr]
+        try:
+            return self[cmdstr]
+        except KeyError:
+            pass
+
+        if strict:
+            matches = self._index.find(cmdstr)
+
+            if len(matches) > 1:
+                raise AmbiguousCommand(matches=matches)
         else:
-            # noinspection PyTypeChecker
-            for key in self.all():
-                if key.startswith(cmdstr):
-                    cmd = self[key]
-                    break
-            else:
-                return None
+            matches = [self._index.first(cmdstr)]
 
-        return cmd
+        try:
+            return self[matches[0]]
+        except (IndexError, KeyError):
+            return None
 
 
 COMMANDS = Commands()  # command : (name, fun_name, module, doc, perms)
 
 
+class StreamBatch(object):
+    """
+    Buffer for stream_output lines. The first line is sent immediately; following lines are joined and sent as one
+    message when the line count or byte budget is reached or when the oldest buffered line is older than interval.
+    """
+    def __init__(self, send, interval=None, lines=None, size=None):
+        self.send = send
+        self.interval = COMMANDS.stream_flush_interval if interval is None else interval
+        self.max_lines = COMMANDS.stream_flush_lines if lines is None else lines
+        self.max_size = COMMANDS.stream_flush_bytes if size is None else size
+        self._buffer = []
+        self._size = 0
+        self._timer = None
+        self._lock = Lock()
+        self.lines = 0
+        self.messages = 0
+
+    def _send(self, text):
+        self.messages += 1
+        self.send(text)
+
+    def _flush(self):
+        # Must be called with self._lock held
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        if self._buffer:
+            text = '\n'.join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self._send(text)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def add(self, line):
+        with self._lock:
+            self.lines += 1
+
+            if self.lines == 1 or self.max_lines <= 1:
+                self._send(line)
+                return
+
+            line_size = len(line) + 1
+
+            if self._buffer and self._size + line_size > self.max_size:
+                self._flush()
+
+            self._buffer.append(line)
+            self._size += line_size
+
+            if len(self._buffer) >= self.max_lines or self._size >= self.max_size:
+                self._flush()
+            elif self._timer is None and self.interval > 0:
+                self._timer = Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+
+def run_with_timeout(timeout, msg, reply, fun, *args):
+    """
+    Run fun(*args) in the current thread. When the timeout (seconds) is reached, a watchdog timer cancels the
+    cancellation token attached to the msg object and sends the timeout error by calling reply(text) (if reply is
+    set) without waiting for the command. The command is not interrupted - it should check the token or register
+    a cancellation callback in order to stop early. CommandTimeout is raised when fun returns or fails after the
+    timeout; its output should be dropped, because the user has already received the error.
+    """
+    token = CancellationToken()
+    msg.cancel_token = token
+    error = 'Command timed out after %s seconds' % timeout
+    finished = Lock()  # Acquired either by the command (finished in time) or by the watchdog (timed out)
+
+    def watchdog():
+        if not finished.acquire(False):  # The command has just finished
+            return
+
+        logger.warning('Command "%s" timed out after %s seconds', msg['body'], timeout)
+        token.cancel()
+
+        if reply:
+            catch_exception(reply)(str(CommandTimeout(error)))
+
+    timer = Timer(timeout, watchdog)
+    timer.daemon = True
+    timer.start()
+
+    try:
+        out = fun(*args)
+    except Exception as e:
+        if finished.acquire(False):  # The command failed before the timeout
+            raise
+
+        # e.g. a process killed by a cancellation callback exits with an error
+        logger.info('Command "%s" failed after timeout: %s', msg['body'], e)
+        raise CommandTimeout(error)
+    finally:
+        timer.cancel()
+
+    if not finished.acquire(False):
+        raise CommandTimeout(error)
+
+    return out
+
+
 # noinspection PyShadowingNames
 def command(func=None, stream_output=False, reply_output=True, user_required=True, admin_required=False,
-            room_user_required=False, room_admin_required=False, parse_parameters=True):
+            room_user_required=False, room_admin_required=False, parse_parameters=True, priority=None,
+            parameter_types=None, cache_ttl=None, cache_per_user=False, coalesce=False, timeout=None):
     """
     Decorator for registering available commands.
+
+    The priority (high, normal or low) selects the dispatcher lane used for running the command.
+    Commands requiring admin permissions run with high priority by default.
+
+    The parameter_types is a mapping of function parameter names to types (a callable or one of: str, int,
+    jid, datetime) used for converting command parameters.
+
+    Output of a command with cache_ttl (seconds) is cached according to command parameters and also according to
+    the user's JID if cache_per_user is True.
+
+    Concurrent invocations of a command with coalesce=True with the same parameters by users with the same
+    permissions are collapsed into one call and all callers receive the same output.
+
+    The timeout (seconds) overrides the global default command timeout (zero disables the timeout). When the
+    timeout is reached the cancellation token (msg.cancel_token) is cancelled and an error is sent to the user
+    immediately; any later command output is dropped. The command runs in the worker thread and is not
+    interrupted - long running commands should check the token or register a cancellation callback.
     """
     def command_decorator(fun):
         # Create command name - skip methods which start with underscore
@@ -218,6 +646,35 @@ def command(func=None, stream_output=False, reply_output=True, user_required=Tru
 
             fun_spec = CommandParameters(len(arg_spec.args[2:]) - kwargs_count, kwargs_count, bool(arg_spec.varargs))
 
+        # Create parameters parser
+        if parameter_types:
+            try:
+                types = dict((i, PARAMETER_TYPES.get(t, t)) for i, t in parameter_types.items())
+                invalid = [i for i, t in types.items() if not hasattr(t, '__call__')]
+            except AttributeError:
+                invalid = parameter_types
+
+            if invalid:
+                logger.critical('Command "%s" from plugin "%s" has invalid parameter types: %s',
+                                name, fun.__module__, invalid)
+                return None
+        else:
+            types = None
+
+        parser = CommandParser(fun_spec, names=arg_spec.args[2:], star_name=arg_spec.varargs, types=types)
+
+        # Dispatcher lane
+        if priority is None:
+            if admin_required:
+                cmd_priority = 'high'
+            else:
+                cmd_priority = 'normal'
+        elif priority in PRIORITIES:
+            cmd_priority = priority
+        else:
+            logger.critical('Command "%s" from plugin "%s" has invalid priority "%s"', name, fun.__module__, priority)
+            return None
+
         # Save documentation
         if fun.__doc__:
             doc = fun.__doc__.strip()
@@ -228,9 +685,85 @@ def command(func=None, stream_output=False, reply_output=True, user_required=Tru
         # Save module, method name and other command metadata
         perms = CommandPermissions(user_required=user_required, admin_required=admin_required,
                                    room_user_required=room_user_required, room_admin_required=room_admin_required)
-        cmd = Command(name, fun.__name__, fun.__module__, doc, perms, fun_spec)
+        cmd = Command(name, fun.__name__, fun.__module__, doc, perms, fun_spec, cmd_priority, parser,
+                      get_permissions_mask(perms))
         COMMANDS[name] = cmd
-        logger.debug('Registered command "%s" (%s) ::\n perms=%s\n fun_spec=%s', name, cmd, perms, fun_spec)
+        logger.debug('Registered command "%s" (%s) ::\n perms=%s\n fun_spec=%s\n priority=%s',
+                     name, cmd, perms, fun_spec, cmd_priority)
+
+        def execute(obj, msg, user, args):
+            """Run the command function with output caching and call coalescing"""
+            if cache_per_user:
+                key = (cmd.module, cmd.name, tuple(args), user)
+            else:
+                key = (cmd.module, cmd.name, tuple(args), None)
+
+            try:
+                hash(key)
+            except TypeError:  # Unhashable parameters
+                return fun(obj, msg, *args)
+
+            if cache_ttl:
+                response = COMMANDS.results.get(key)
+
+                if response is not None:
+                    logger.debug('Command "%s" output served from cache', cmd)
+                    return response
+
+            if coalesce:
+                key_class = key + (cmd.get_permission_class(obj.xmpp, user),)
+                response = COMMANDS.inflight.do(key_class, fun, obj, msg, *args)
+            else:
+                response = fun(obj, msg, *args)
+
+            if cache_ttl and response is not None:
+                COMMANDS.results.set(key, response, ttl=cache_ttl)
+
+            return response
+
+        def run(obj, msg, user, args, kwargs, stream, reply):
+            """Run the command function and return command output"""
+            if (cache_ttl or coalesce) and not (stream or kwargs):
+                return execute(obj, msg, user, args)
+
+            response = fun(obj, msg, *args, **kwargs)
+
+            if not stream:
+                return response
+
+            token = msg.cancel_token
+            _out = []
+
+            if reply:
+                if response:
+                    def send(text):
+                        if not (token and token.cancelled):  # Drop output after timeout
+                            obj.xmpp.msg_reply(msg, text, preserve_msg=True, paginate=False)
+
+                    batch = StreamBatch(send)
+
+                    try:
+                        for line in response:
+                            if token and token.cancelled:
+                                break
+
+                            _out.append(line)
+                            batch.add(line)
+                    finally:
+                        batch.flush()
+
+                    logger.debug('Command "%s" streamed %d line(s) in %d message(s)', name, batch.lines,
+                                 batch.messages)
+                else:
+                    obj.xmpp.msg_reply(msg, '(no response)', preserve_msg=True)
+            elif response:
+                for line in response:
+                    if token and token.cancelled:
+                        break
+
+                    _out.append(line)
+
+            return '\n'.join(_out)
 
         @wraps(fun)
         def wrap(obj, msg, *args, **kwargs):
@@ -254,27 +787,28 @@ def command(func=None, stream_output=False, reply_output=True, user_required=Tru
                     raise PermissionDenied
 
                 if parse_parameters:  # Parse command parameters
-                    args = cmd.get_args_from_msg_body(body)
+                    args = cmd.parser.parse(body)
 
                 # Reply with function output
-                response = fun(obj, msg, *args, **kwargs)
+                if timeout is None:
+                    cmd_timeout = COMMANDS.default_timeout
+                else:
+                    cmd_timeout = timeout
 
-                if stream:
+                if cmd_timeout:
                     if reply:
-                        _out = []
-
-                        if response:
-                            for line in response:
-                                _out.append(line)
-                                xmpp.msg_reply(msg, line, preserve_msg=True)
-                        else:
-                            xmpp.msg_reply(msg, '(no response)', preserve_msg=True)
+                        def send_error(text):
+                            xmpp.msg_reply(msg, text, preserve_msg=True)
                     else:
-                        _out = response
+                        send_error = None
 
-                    out = '\n'.join(_out)
+                    out = run_with_timeout(cmd_timeout, msg, send_error, run, obj, msg, user, args, kwargs, stream,
+                                           reply)
                 else:
-                    out = response
+                    out = run(obj, msg, user, args, kwargs, stream, reply)
+            except CommandTimeout as e:
+                logger.info('Dropping output of command "%s" (%s) from "%s" after timeout', body, cmd, user)
+                return str(e)  # The error was already sent by the watchdog
             except CommandError as e:
                 out = str(e)
             except Exception as e:
@@ -289,7 +823,10 @@ def command(func=None, stream_output=False, reply_output=True, user_required=Tru
                 if stream and success:
                     return out
 
-                xmpp.msg_reply(msg, out)
+                if success:
+                    xmpp.msg_reply(msg, xmpp.shorten_output(out, private=msg['type'] != 'groupchat'))
+                else:
+                    xmpp.msg_reply(msg, out)
 
             return out
 
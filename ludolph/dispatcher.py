@@ -0,0 +1,217 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+import logging
+import time
+from threading import Thread, Lock
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from ordereddict import OrderedDict
+
+try:
+    # noinspection PyCompatibility
+    from queue import Queue, Full, Empty
+except ImportError:
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from Queue import Queue, Full, Empty
+
+__all__ = ('Dispatcher',)
+
+logger = logging.getLogger(__name__)
+
+# Jobs are submitted from the SleekXMPP event thread, which must never block -> a full queue always drops a job
+OVERFLOW_POLICIES = frozenset(['drop', 'drop_oldest'])
+
+
+class Lane(object):
+    """
+    Bounded job queue drained by a fixed pool of worker threads.
+    """
+    def __init__(self, name, workers, queue_size=0, overflow='drop_oldest'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Invalid overflow policy "%s"' % overflow)
+
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.queue = Queue(queue_size)
+        self._threads = []
+        self._lock = Lock()
+        # Statistics
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def __repr__(self):
+        return '%s(%s, workers=%s)' % (self.__class__.__name__, self.name, self.workers)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = Thread(target=self._worker, name='dispatcher-%s-%d' % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        # Pending jobs are thrown away; the sentinel tells the worker to exit
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+
+        for _ in self._threads:
+            self.queue.put(None)
+
+        for thread in self._threads:
+            thread.join(1)
+
+        del self._threads[:]
+
+    def put(self, fun, args):
+        """Enqueue job according to the overflow policy. Return False if the job was dropped"""
+        job = (time.time(), fun, args)
+
+        if self.overflow == 'drop':
+            try:
+                self.queue.put_nowait(job)
+            except Full:
+                return self._dropped(fun)
+        else:  # drop_oldest
+            while True:
+                try:
+                    self.queue.put_nowait(job)
+                except Full:
+                    try:
+                        _, old_fun, _ = self.queue.get_nowait()
+                    except Empty:
+                        continue
+                    else:
+                        self._dropped(old_fun)
+                else:
+                    break
+
+        with self._lock:
+            self.submitted += 1
+            depth = self.queue.qsize()
+
+            if depth > self.max_depth:
+                self.max_depth = depth
+
+        return True
+
+    def _dropped(self, fun):
+        with self._lock:
+            self.dropped += 1
+
+        logger.warning('Dispatcher lane "%s" is full (%d jobs) - dropping job %s', self.name, self.queue_size, fun)
+
+        return False
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+
+            if job is None:
+                break
+
+            submit_time, fun, args = job
+            wait_time = time.time() - submit_time
+
+            with self._lock:
+                self.wait_time_total += wait_time
+
+                if wait_time > self.wait_time_max:
+                    self.wait_time_max = wait_time
+
+            try:
+                fun(*args)
+            except Exception as e:
+                logger.exception(e)
+                logger.error('Got exception when running dispatched job %s: %s', fun, e)
+            finally:
+                with self._lock:
+                    self.processed += 1
+
+    def display_stats(self):
+        """Return lane statistics suitable for logging"""
+        if self.processed:
+            wait_time_avg = self.wait_time_total / self.processed
+        else:
+            wait_time_avg = 0.0
+
+        return '%s: workers=%d depth=%d max_depth=%d submitted=%d processed=%d dropped=%d ' \
+               'wait_avg=%.3fs wait_max=%.3fs' % (self.name, self.workers, self.queue.qsize(), self.max_depth,
+                                                  self.submitted, self.processed, self.dropped,
+                                                  wait_time_avg, self.wait_time_max)
+
+
+class Dispatcher(object):
+    """
+    Worker pool used for processing inbound stanzas instead of running one thread per stanza.
+    Jobs are separated into priority lanes - each lane has its own queue and workers.
+    """
+    default_lane = 'normal'
+    running = False
+
+    def __init__(self, workers, queue_size=0, overflow='drop_oldest', lanes=None):
+        """
+        The workers parameter is the number of workers in the default lane.
+        Additional lanes can be specified as a {name: workers} mapping.
+        """
+        self.lanes = OrderedDict()
+
+        if lanes:
+            for name, lane_workers in lanes.items():
+                if lane_workers > 0:
+                    self.lanes[name] = Lane(name, lane_workers, queue_size=queue_size, overflow=overflow)
+
+        self.lanes[self.default_lane] = Lane(self.default_lane, workers, queue_size=queue_size, overflow=overflow)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(map(repr, self.lanes.values())))
+
+    def start(self):
+        assert not self.running, 'Dispatcher is already running?'
+
+        for lane in self.lanes.values():
+            logger.info('Starting dispatcher lane "%s" with %d worker(s)', lane.name, lane.workers)
+            lane.start()
+
+        self.running = True
+
+    def stop(self):
+        assert self.running, 'Dispatcher was not started?'
+        logger.info('Stopping dispatcher')
+        self.running = False
+
+        for lane in self.lanes.values():
+            lane.stop()
+
+    def submit(self, fun, *args):
+        """Schedule fun(*args) to be run by a worker thread from the default lane"""
+        return self.lanes[self.default_lane].put(fun, args)
+
+    def submit_to(self, lane, fun, *args):
+        """Schedule fun(*args) to be run by a worker thread from a specific lane (or the default lane)"""
+        try:
+            lane = self.lanes[lane]
+        except KeyError:
+            lane = self.lanes[self.default_lane]
+
+        return lane.put(fun, args)
+
+    def display_stats(self):
+        """Return list of dispatcher statistics suitable for logging"""
+        return [lane.display_stats() for lane in self.lanes.values()]
@@ -7,54 +7,49 @@ See the file LICENSE for copying permission.
 """
 import logging
 import re
+from copy import copy, deepcopy
 from datetime import datetime, timedelta
 from sleekxmpp.xmlstream import ET
 from sleekxmpp.stanza import Message
-try:
-    from xml.etree.ElementTree import ParseError
-except ImportError:
-    from xml.parsers.expat import ExpatError as ParseError
 
-__all__ = ('red', 'green', 'blue', 'IncomingLudolphMessage', 'OutgoingLudolphMessage')
+from ludolph.utils import LRUCache
+
+__all__ = ('red', 'green', 'blue', 'IncomingLudolphMessage', 'OutgoingLudolphMessage', 'StanzaView')
 
 logger = logging.getLogger(__name__)
 r = re.compile
 
-TEXT2BODY = (
-    (r(r'\*\*(.+?)\*\*'), r'*\1*'),
-    (r(r'__(.+?)__'), r'\1'),
-    (r(r'\^\^(.+?)\^\^'), r'\1'),
-    (r(r'~~(.+?)~~'), r'\1'),
-    (r(r'%{(.+?)}(.+)%'), r'\2'),
-    (r(r'\[\[(.+?)\|(.+?)\]\]'), r'\1'),
+# Ludolph markup (the dot does not match a newline -> markup is applied to single lines only)
+MARKUP_RX = r(
+    r'(?=[*_^~\[%])'  # Quick check of the first character (speeds up the search)
+    r'(?:\*\*(?P<b>.+?)\*\*'
+    r'|__(?P<i>.+?)__'
+    r'|\^\^(?P<sup>.+?)\^\^'
+    r'|~~(?P<sub>.+?)~~'
+    r'|\[\[(?P<href>.+?)\|(?P<a>.+?)\]\]'
+    r'|%{(?P<style>.+?)}(?P<span>.+?)%)'
 )
 
-TEXT2HTML = (
-    ('&', '&#38;'),
-    ('<', '&#60;'),
-    ('>', '&#62;'),
-    ("'", '&#39;'),
-    ('"', '&#34;'),
-    (r(r'\*\*(.+?)\*\*'), r'<b>\1</b>'),
-    (r(r'__(.+?)__'), r'<i>\1</i>'),
-    (r(r'\^\^(.+?)\^\^'), r'<sup>\1</sup>'),
-    (r(r'~~(.+?)~~'), r'<sub>\1</sub>'),
-    (r(r'\[\[(.+?)\|(.+?)\]\]'), r'<a href="\1">\2</a>'),
-    (r(r'%{(.+?)}(.+?)%'), r'<span style="\1">\2</span>'),
-    (r(r'(ERROR)'), r'<span style="color:#FF0000;">\1</span>'),
-    (r(r'(PROBLEM|OFF)'), r'<span style="color:#FF0000;"><strong>\1</strong></span>'),
-    (r(r'(OK|ON)'), r'<span style="color:#00FF00;"><strong>\1</strong></span>'),
-    (r(r'([Dd]isaster)'), r'<span style="color:#FF0000;"><strong>\1</strong></span>'),
-    (r(r'([Cc]ritical)'), r'<span style="color:#FF3300;"><strong>\1</strong></span>'),
-    (r(r'([Hh]igh)'), r'<span style="color:#FF6600;"><strong>\1</strong></span>'),
-    (r(r'([Aa]verage)'), r'<span style="color:#FF9900;"><strong>\1</strong></span>'),
-    (r(r'([Ww]arning)'), r'<span style="color:#FFCC00;"><strong>\1</strong></span>'),
-    # (r(r'([Ii]nformation)'), r'<span style="color:#FFFF00;"><strong>\1</strong></span>'),
-    (r(r'(Monitored)'), r'<span style="color:#00FF00;"><strong>\1</strong></span>'),
-    (r(r'(Not\ monitored)'), r'<span style="color:#FF0000;"><strong>\1</strong></span>'),
-    ('\n', '<br/>\n'),
+# Severity and status keywords highlighted in html: (regex, span style, strong)
+KEYWORDS = (
+    (r'ERROR', 'color:#FF0000;', False),
+    (r'PROBLEM|OFF', 'color:#FF0000;', True),
+    (r'OK|ON', 'color:#00FF00;', True),
+    (r'[Dd]isaster', 'color:#FF0000;', True),
+    (r'[Cc]ritical', 'color:#FF3300;', True),
+    (r'[Hh]igh', 'color:#FF6600;', True),
+    (r'[Aa]verage', 'color:#FF9900;', True),
+    (r'[Ww]arning', 'color:#FFCC00;', True),
+    # (r'[Ii]nformation', 'color:#FFFF00;', True),
+    (r'Monitored', 'color:#00FF00;', True),
+    (r'Not\ monitored', 'color:#FF0000;', True),
 )
 
+# Newlines (first group) and keywords are found in one pass.
+# The lookahead contains the first characters of all keywords.
+TEXT2HTML_RX = r('(?=[\nEPODdCcHhAaWwMN])(?:(\n)|%s)' % '|'.join('(%s)' % rx for rx, _, _ in KEYWORDS))
+TEXT2HTML_KEYWORDS = (None, None) + tuple((style, strong) for _, style, strong in KEYWORDS)  # match.lastindex
+
 
 class MessageError(Exception):
     """
@@ -63,6 +58,183 @@ class MessageError(Exception):
     pass
 
 
+def _append_text(element, text):
+    """Append text to the end of the element's content"""
+    if len(element):
+        last = element[-1]
+        last.tail = (last.tail or '') + text
+    else:
+        element.text = (element.text or '') + text
+
+
+def _text2html(element, text):
+    """Append text to element, replace newlines with <br/> and highlight keywords"""
+    pos = 0
+
+    for match in TEXT2HTML_RX.finditer(text):
+        start = match.start()
+
+        if start > pos:
+            _append_text(element, text[pos:start])
+
+        pos = match.end()
+        index = match.lastindex
+
+        if index == 1:
+            ET.SubElement(element, 'br').tail = '\n'
+        else:
+            style, strong = TEXT2HTML_KEYWORDS[index]
+            span = ET.SubElement(element, 'span', style=style)
+
+            if strong:
+                ET.SubElement(span, 'strong').text = match.group()
+            else:
+                span.text = match.group()
+
+    if pos < len(text):
+        _append_text(element, text[pos:])
+
+
+def _render(text, element):
+    """Render Ludolph markup into element (skipped if element is None). Return plain text body"""
+    body = []
+    pos = 0
+
+    for match in MARKUP_RX.finditer(text):
+        start = match.start()
+
+        if start > pos:
+            plain = text[pos:start]
+            body.append(plain)
+
+            if element is not None:
+                _text2html(element, plain)
+
+        pos = match.end()
+        kind = match.lastgroup
+        inner = match.group(kind)
+
+        if element is None:
+            child = None
+        elif kind == 'a':
+            child = ET.SubElement(element, 'a', href=match.group('href'))
+        elif kind == 'span':
+            child = ET.SubElement(element, 'span', style=match.group('style'))
+        else:
+            child = ET.SubElement(element, kind)
+
+        if kind == 'a':
+            body.append(_render(match.group('href'), None))
+            _render(inner, child)
+        elif kind == 'b':
+            body.append('*' + _render(inner, child) + '*')
+        else:  # i, sup, sub, span
+            body.append(_render(inner, child))
+
+    if pos == 0:  # No markup
+        if element is not None:
+            _text2html(element, text)
+
+        return text
+
+    if pos < len(text):
+        plain = text[pos:]
+        body.append(plain)
+
+        if element is not None:
+            _text2html(element, plain)
+
+    return ''.join(body)
+
+
+def render_markup(text, html=True):
+    """
+    Convert text with Ludolph markup into plain text message body and html (XML element) in one pass.
+    Markup cannot span multiple lines. The html part is None if html is False.
+    """
+    if not html:
+        return _render(text, None), None
+
+    element = ET.Element('div')
+    element.text = '\n'
+    body = _render(text, element)
+    _append_text(element, '\n')
+
+    return body, element
+
+
+def _find_split_position(line, max_size):
+    """Return position in line (<= max_size) suitable for splitting the line (on whitespace outside of markup)"""
+    spans = [match.span() for match in MARKUP_RX.finditer(line)]
+
+    def breaks_markup(position):
+        return any(start < position < end for start, end in spans)
+
+    pos = line.rfind(' ', 0, max_size)
+
+    while pos > 0:
+        if not breaks_markup(pos + 1):
+            return pos + 1
+
+        pos = line.rfind(' ', 0, pos)
+
+    for start, end in spans:
+        if start < max_size < end:
+            if start > 0:
+                return start
+            break
+
+    return max_size  # Unable to find a better place
+
+
+def split_markup(text, max_size):
+    """
+    Split text with Ludolph markup into a list of texts not longer than max_size characters. The text is split on line
+    boundaries, which never breaks markup. Lines longer than max_size are split on whitespace outside of markup.
+    """
+    parts = []
+    lines = []
+    size = 0
+
+    for line in text.split('\n'):
+        while len(line) > max_size:
+            if lines:
+                parts.append('\n'.join(lines))
+                lines = []
+                size = 0
+
+            pos = _find_split_position(line, max_size)
+            parts.append(line[:pos])
+            line = line[pos:]
+
+        if lines and size + 1 + len(line) > max_size:
+            parts.append('\n'.join(lines))
+            lines = []
+            size = 0
+
+        if lines:
+            size += 1 + len(line)
+        else:
+            size = len(line)
+
+        lines.append(line)
+
+    if lines:
+        parts.append('\n'.join(lines))
+
+    return parts
+
+
+def _sizeof_rendered(text, body, html):
+    """Rough estimate of memory used by a rendered message"""
+    size = 2 * (len(text) + len(body))
+
+    if html is not None:
+        size += 256 * sum(1 for _ in html.iter())
+
+    return size
+
+
 def red(s):
     return '%%{color:#FF0000}%s%%' % s
 
@@ -81,6 +253,19 @@ class IncomingLudolphMessage(Message):
     SleekXMPP Message object wrapper.
     """
     _ludolph_attrs = ('reply_output', 'stream_output')
+    _wrapped_classes = {}  # (cls, original message class): wrapped message class
+
+    @classmethod
+    def _get_wrapped_class(cls, msg_class):
+        """Return a subclass of our class and the original message class (created only once per message class)"""
+        key = (cls, msg_class)
+
+        try:
+            return cls._wrapped_classes[key]
+        except KeyError:
+            wrapped_class = type(msg_class.__name__, (cls, msg_class), {})
+            # The dict.setdefault method is atomic -> all threads will get the same class
+            return cls._wrapped_classes.setdefault(key, wrapped_class)
 
     @classmethod
     def wrap_msg(cls, msg):
@@ -88,8 +273,8 @@ class IncomingLudolphMessage(Message):
         if isinstance(msg, cls):
             raise TypeError('Message object is already wrapped')
 
-        obj = cls()
-        obj.__class__ = type(msg.__class__.__name__, (cls, msg.__class__), {})
+        wrapped_class = cls._get_wrapped_class(msg.__class__)
+        obj = object.__new__(wrapped_class)  # No need to run __init__ - the object will share msg's attributes
         obj.__dict__ = msg.__dict__
 
         return obj
@@ -153,69 +338,197 @@ class IncomingLudolphMessage(Message):
 
     stream_output = property(get_stream_output, set_stream_output)
 
+    def get_cancel_token(self):
+        return self._get_ludolph_attr('_cancel_token_', None)
+
+    def set_cancel_token(self, value):
+        self._cancel_token_ = value
+
+    cancel_token = property(get_cancel_token, set_cancel_token)  # Set by commands running with a timeout
+
+
+class StanzaView(object):
+    """
+    Proxy of a stanza shared by multiple event handlers. A read-only view raises TypeError on any attempt to modify
+    the stanza. A mutable view is copy-on-write: the stanza is copied just before it is modified for the first time.
+    """
+    __slots__ = ('_stanza', '_copy', '_mutable')
+    # Methods modifying the stanza (in addition to methods starting with set_ or del_)
+    _mutating_methods = frozenset(['reply', 'clear', 'append', 'appendxml', 'enable', 'setStanzaValues',
+                                   'get_reply_output', 'get_stream_output'])  # The getters can set default values
+
+    def __init__(self, stanza, mutable=False):
+        object.__setattr__(self, '_stanza', stanza)
+        object.__setattr__(self, '_copy', None)
+        object.__setattr__(self, '_mutable', mutable)
+
+    def _get_stanza(self, write=False):
+        if self._copy is not None:
+            return self._copy
+
+        if not write:
+            return self._stanza
+
+        if not self._mutable:
+            raise TypeError('Stanza is read-only')
+
+        stanza = copy(self._stanza)
+        object.__setattr__(self, '_copy', stanza)
+
+        return stanza
+
+    @property
+    def __class__(self):  # isinstance() should work as with the original stanza
+        return self._get_stanza().__class__
+
+    def __getattr__(self, name):
+        write = name in self._mutating_methods or name.startswith(('set_', 'del_'))
+
+        return getattr(self._get_stanza(write=write), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_stanza(write=True), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._get_stanza(write=True), name)
+
+    def __getitem__(self, key):
+        value = self._get_stanza()[key]
+
+        if self._copy is None and hasattr(value, 'xml'):  # Sub-stanza of the shared stanza
+            if self._mutable:
+                # Sub-stanzas are returned from the copy, because the caller may modify them
+                value = self._get_stanza(write=True)[key]
+            else:
+                value = StanzaView(value)
+
+        return value
+
+    def __setitem__(self, key, value):
+        self._get_stanza(write=True)[key] = value
+
+    def __delitem__(self, key):
+        del self._get_stanza(write=True)[key]
+
+    def __contains__(self, item):
+        return item in self._get_stanza()
+
+    def __iter__(self):
+        return iter(self._get_stanza())
+
+    def __copy__(self):
+        return copy(self._get_stanza())
+
+    def __deepcopy__(self, memo):
+        return deepcopy(self._get_stanza(), memo)
+
+    def __str__(self):
+        return str(self._get_stanza())
+
+    def __repr__(self):
+        return repr(self._get_stanza())
+
 
 class OutgoingLudolphMessage(object):
     """
     Creating and sending bots messages (replies).
     """
+    render_cache_size = 1048576  # Default size of the rendered messages cache (bytes)
+    render_cache = LRUCache(render_cache_size)  # text: (body, html template)
+
     def __init__(self, mbody, mhtml=None, mtype=None, msubject=None, delay=None, timestamp=None):
         """
-        Construct message body in plain text and html.
+        Construct message body in plain text and html. The text is rendered when the message is being sent.
         """
         self.mtype = mtype
         self.msubject = msubject
+        self._rendered = None  # (body, html) or (body, None)
 
-        if mbody is not None:
-            self.mbody = self._text2body(str(mbody))
+        if mbody is None:
+            self._text = None
+        else:
+            self._text = str(mbody).strip()
 
         if mhtml is None and mbody is not None:
-            self.mhtml = self._text2html(str(mbody))
+            self._mhtml = None  # Rendered from text
         else:
-            self.mhtml = str(mhtml)
+            self._mhtml = str(mhtml)
 
         if delay:
             timestamp = datetime.utcnow() + timedelta(seconds=delay)
 
         self.timestamp = timestamp
 
-    @staticmethod
-    def _replace(replist, text):
+    @classmethod
+    def _render(cls, text, html=True):
         """
-        Helper for replacing text parts according to replist.
+        Return message body and html element. Rendered messages are cached and the cached html element is used as a
+        template, which is copied for every new message.
         """
-        for rx, te in replist:
-            # noinspection PyProtectedMember
-            if isinstance(rx, re._pattern_type):
-                try:
-                    text = rx.sub(te, text)
-                except re.error as exc:
-                    logger.error('Regexp error during message text replacement: %s', exc)
-            else:
-                text = text.replace(rx, te)
+        cache = cls.render_cache
 
-        return text
+        if not cache.max_size:
+            return render_markup(text, html=html)
 
-    def _text2body(self, text):
-        """
-        Remove tags from text.
-        """
-        body = self._replace(TEXT2BODY, text.strip())
+        rendered = cache.get(text)
+
+        if rendered is None or (html and rendered[1] is None):
+            body, element = render_markup(text, html=html)
+            cache.set(text, (body, element), size=_sizeof_rendered(text, body, element))
+        else:
+            body, element = rendered
+
+        if html:
+            return body, deepcopy(element)
+
+        return body, None
+
+    def _copy(self, text):
+        return self.__class__(text, mtype=self.mtype, msubject=self.msubject, timestamp=self.timestamp)
+
+    def _get_rendered(self, html=False):
+        rendered = self._rendered
+
+        if rendered is None or (html and rendered[1] is None):
+            rendered = self._rendered = self._render(self._text, html=html)
+
+        return rendered
+
+    @property
+    def text(self):
+        """Source text with Ludolph markup"""
+        return self._text
+
+    @property
+    def mbody(self):
+        """Plain text message body"""
+        if self._text is None:
+            return None
+
+        return self._get_rendered()[0]
+
+    @property
+    def mhtml(self):
+        """XHTML-IM message body"""
+        if self._mhtml is None and self._text is not None:
+            return self._get_rendered(html=True)[1]
 
-        return body
+        return self._mhtml
 
-    def _text2html(self, text):
+    def split(self, max_size, suffix=''):
         """
-        Convert text to html.
+        Split message into a list of messages with text not longer than max_size characters (see split_markup()).
+        The suffix is appended to all messages except the last one. Messages with custom html are never split.
         """
-        html = self._replace(TEXT2HTML, text.strip())
-        html = '<div>\n' + html + '\n</div>'
+        text = self._text
 
-        try:
-            # noinspection PyUnresolvedReferences
-            return ET.XML(html)
-        except (ParseError, SyntaxError) as e:
-            logger.error('Could not parse html: %s', e)
-            return None
+        if text is None or len(text) <= max_size or self._mhtml is not None:
+            return [self]
+
+        parts = split_markup(text, max(max_size - len(suffix), 1))
+        last = parts.pop()
+
+        return [self._copy(part + suffix) for part in parts] + [self._copy(last)]
 
     @classmethod
     def create(cls, mbody, **kwargs):
@@ -227,29 +540,95 @@ class OutgoingLudolphMessage(object):
 
         return cls(mbody, **kwargs)
 
-    def send(self, xmpp, mto, mfrom=None, mnick=None):
-        """
-        Send a new message.
-        """
-        msg = xmpp.client.make_message(mto, self.mbody, msubject=self.msubject, mtype=self.mtype, mhtml=self.mhtml,
+    def _make_stanza(self, xmpp, mto, xhtml, mfrom=None, mnick=None):
+        if xhtml:
+            mhtml = self.mhtml
+        else:
+            mhtml = None
+
+        msg = xmpp.client.make_message(mto, self.mbody, msubject=self.msubject, mtype=self.mtype, mhtml=mhtml,
                                        mfrom=mfrom, mnick=mnick)
 
         if self.timestamp:
             msg['delay'].set_stamp(self.timestamp)
 
-        return msg.send()
+        return msg
+
+    def send(self, xmpp, mto, mfrom=None, mnick=None):
+        """
+        Send a new message. The html part is omitted for recipients without XHTML-IM support.
+        """
+        msg = self._make_stanza(xmpp, mto, xmpp.is_jid_xhtml_capable(mto, mtype=self.mtype), mfrom=mfrom, mnick=mnick)
+
+        return xmpp.send_stanza(msg)
+
+    def fan_out(self, xmpp, recipients, mfrom=None):
+        """
+        Return list of message stanzas for multiple recipients. The stanza is created only once (one with and one
+        without the html part) and copied for other recipients.
+        """
+        templates = {}  # XHTML-IM support: stanza
+        stanzas = []
+
+        for mto in recipients:
+            xhtml = xmpp.is_jid_xhtml_capable(mto, mtype=self.mtype)
 
-    def reply(self, msg, clear=True):
+            try:
+                msg = copy(templates[xhtml])
+            except KeyError:
+                msg = templates[xhtml] = self._make_stanza(xmpp, mto, xhtml, mfrom=mfrom)
+            else:
+                msg['to'] = mto
+
+            stanzas.append(msg)
+
+        return stanzas
+
+    def multicast(self, xmpp, service, recipients, max_recipients=0):
+        """
+        Return list of (message stanza, recipients) pairs for the XEP-0033 multicast service. Recipients are grouped by
+        their XHTML-IM support and added as blind carbon copy addresses (max_recipients per stanza, 0 = unlimited).
+        """
+        groups = {}  # XHTML-IM support: [recipients]
+
+        for mto in recipients:
+            groups.setdefault(xmpp.is_jid_xhtml_capable(mto, mtype=self.mtype), []).append(mto)
+
+        res = []
+
+        for xhtml, jids in groups.items():
+            template = self._make_stanza(xmpp, service, xhtml)
+            step = max_recipients or len(jids)
+
+            for i in range(0, len(jids), step):
+                chunk = jids[i:i + step]
+                msg = copy(template)
+                addresses = msg['addresses']
+
+                for mto in chunk:
+                    addresses.add_address(atype='bcc', jid=mto)
+
+                res.append((msg, chunk))
+
+        return res
+
+    def reply(self, msg, clear=True, xmpp=None):
         """
         Send a reply to incoming msg.
+        The html part is omitted for recipients without XHTML-IM support (if the xmpp parameter is set).
         """
         msg.reply(self.mbody, clear=clear)
-        msg['html']['body'] = self.mhtml
+
+        if xmpp is None or xmpp.is_jid_xhtml_capable(msg['to'], mtype=msg['type']):
+            msg['html']['body'] = self.mhtml
 
         if self.timestamp:
             msg['delay'].set_stamp(self.timestamp)
 
-        return msg.send()
+        if xmpp is None:
+            return msg.send()
+
+        return xmpp.send_stanza(msg, priority=True)
 
 
 LudolphMessage = OutgoingLudolphMessage  # Backward compatibility
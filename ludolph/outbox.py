@@ -0,0 +1,295 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+import logging
+import time
+from collections import deque
+from threading import Thread, Condition, Event, Lock, Timer
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from ordereddict import OrderedDict
+
+from ludolph.ratelimit import TokenBucket
+
+__all__ = ('SendQueue', 'Aggregator')
+
+logger = logging.getLogger(__name__)
+
+
+class SendQueue(object):
+    """
+    Outbound stanza queue drained by one sender thread. The traffic is shaped by token buckets (messages per second
+    and bytes per second) with a burst allowance. Stanzas from the high priority lane (replies to commands) are always
+    sent before stanzas from the normal lane. Stanzas remaining in the high priority lane are sent without traffic
+    shaping when the queue is stopped; the normal lane is discarded.
+    """
+    running = False
+
+    def __init__(self, rate=0, byte_rate=0, burst=1):
+        """Zero rate or byte_rate means no limit. Burst is the number of messages which can be sent at once"""
+        burst = max(burst, 1)
+
+        if rate > 0:
+            self.messages = TokenBucket(burst, rate)
+        else:
+            self.messages = None
+
+        if byte_rate > 0:
+            self.bytes = TokenBucket(byte_rate * burst / rate if rate > 0 else byte_rate, byte_rate)
+        else:
+            self.bytes = None
+
+        self.lanes = (('high', deque()), ('normal', deque()))
+        self._cond = Condition()
+        self._stopped = Event()
+        self._thread = None
+        # Statistics
+        self.sent = 0
+        self.sent_bytes = 0
+        self.max_depth = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.throttled = 0.0  # Total time spent waiting for tokens
+
+    def __repr__(self):
+        return '%s(messages=%r, bytes=%r)' % (self.__class__.__name__, self.messages, self.bytes)
+
+    def __len__(self):
+        return sum(len(queue) for _, queue in self.lanes)
+
+    def start(self):
+        assert not self.running, 'Send queue is already running?'
+        logger.info('Starting send queue: %r', self)
+        self._stopped.clear()
+        self._thread = Thread(target=self._sender, name='outbox')
+        self._thread.daemon = True
+        self._thread.start()
+        self.running = True
+
+    def stop(self, timeout=5):
+        """Send all stanzas from the high priority lane (waiting at most timeout seconds) and stop the sender"""
+        assert self.running, 'Send queue was not started?'
+        logger.info('Stopping send queue (%d stanza(s) in high priority lane)', len(self.lanes[0][1]))
+        self.running = False
+        self._stopped.set()
+
+        with self._cond:
+            self._cond.notify()
+
+        self._thread.join(timeout)
+        pending = len(self)
+
+        if pending:
+            logger.warning('Send queue stopped with %d unsent stanza(s)', pending)
+
+    def put(self, stanza, priority=False):
+        """Enqueue stanza for sending. The stanza will be sent before other stanzas if priority is True"""
+        return self.put_many((stanza,), priority=priority)
+
+    def put_many(self, stanzas, priority=False):
+        """Enqueue multiple stanzas at once"""
+        now = time.time()
+
+        if self.bytes:
+            jobs = [(now, stanza, len(str(stanza))) for stanza in stanzas]
+        else:
+            jobs = [(now, stanza, 0) for stanza in stanzas]
+
+        with self._cond:
+            self.lanes[0 if priority else 1][1].extend(jobs)
+            depth = len(self)
+
+            if depth > self.max_depth:
+                self.max_depth = depth
+
+            self._cond.notify()
+
+        return True
+
+    def _get(self):
+        with self._cond:
+            while not self._stopped.is_set():
+                for _, queue in self.lanes:
+                    if queue:
+                        return queue.popleft()
+
+                self._cond.wait()
+
+            high = self.lanes[0][1]
+
+            if high:  # Drain the high priority lane after stop
+                return high.popleft()
+
+        return None
+
+    def _throttle(self, bucket, tokens):
+        """Wait for tokens (a larger amount than capacity is served when the bucket is full)"""
+        tokens = min(tokens, bucket.capacity)
+        start = time.time()
+
+        while bucket.refill() < tokens:
+            if self._stopped.wait((tokens - bucket.tokens) / bucket.rate):
+                return
+
+        bucket.tokens -= tokens
+        self.throttled += time.time() - start
+
+    def _sender(self):
+        while True:
+            job = self._get()
+
+            if job is None:
+                break
+
+            submit_time, stanza, size = job
+
+            if self.messages:
+                self._throttle(self.messages, 1)
+
+            if self.bytes:
+                self._throttle(self.bytes, size)
+
+            try:
+                stanza.send()
+            except Exception as e:
+                logger.exception(e)
+                logger.error('Could not send stanza: %s', e)
+                continue
+
+            latency = time.time() - submit_time
+            self.sent += 1
+            self.sent_bytes += size
+            self.latency_total += latency
+
+            if latency > self.latency_max:
+                self.latency_max = latency
+
+    def display_stats(self):
+        """Return send queue statistics suitable for logging"""
+        if self.sent:
+            latency_avg = self.latency_total / self.sent
+        else:
+            latency_avg = 0.0
+
+        return 'depth=%s max_depth=%d sent=%d sent_bytes=%d latency_avg=%.3fs latency_max=%.3fs throttled=%.3fs' % (
+            '/'.join('%s:%d' % (name, len(queue)) for name, queue in self.lanes), self.max_depth, self.sent,
+            self.sent_bytes, latency_avg, self.latency_max, self.throttled)
+
+
+class Aggregator(object):
+    """
+    Group notifications for the same destination (key) into one digest message. The first notification for a quiet
+    destination is sent immediately and opens an aggregation window. Notifications received during the window are
+    sent as one digest (identical texts are deduplicated with a counter) when the window expires or when max_items
+    notifications are collected. The window stays open as long as new notifications keep coming.
+    """
+    def __init__(self, send, window=2.0, max_items=50):
+        """The send callback is called with key and text arguments"""
+        self.send = send
+        self.window = window
+        self.max_items = max_items
+        self._groups = {}  # key: {text: count} (OrderedDict) or None if the window is open without pending items
+        self._timers = {}
+        self._lock = Lock()
+        # Statistics
+        self.received = 0
+        self.sent = 0
+
+    def __repr__(self):
+        return '%s(window=%r, max_items=%r)' % (self.__class__.__name__, self.window, self.max_items)
+
+    def __len__(self):
+        with self._lock:
+            return sum(sum(items.values()) for items in self._groups.values() if items)
+
+    @staticmethod
+    def format_digest(items):
+        """Return digest text from {text: count} mapping"""
+        return '\n'.join(text if count == 1 else '%s (%dx)' % (text, count) for text, count in items.items())
+
+    def _start_timer(self, key):
+        timer = self._timers[key] = Timer(self.window, self._expire, (key,))
+        timer.daemon = True
+        timer.start()
+
+    def _send(self, key, text):
+        self.sent += 1
+
+        try:
+            self.send(key, text)
+        except Exception as e:
+            logger.exception(e)
+            logger.error('Could not send aggregated message to %s: %s', key, e)
+
+    def _expire(self, key):
+        with self._lock:
+            items = self._groups.pop(key, None)
+            self._timers.pop(key, None)
+
+            if items:  # Keep the window open
+                self._groups[key] = None
+                self._start_timer(key)
+
+        if items:
+            self._send(key, self.format_digest(items))
+
+    def add(self, key, text):
+        """Send text to destination identified by key now or later as part of a digest"""
+        items = None
+
+        with self._lock:
+            self.received += 1
+
+            if key not in self._groups:
+                self._groups[key] = None
+                self._start_timer(key)
+                send_now = True
+            else:
+                send_now = False
+                group = self._groups[key]
+
+                if group is None:
+                    group = self._groups[key] = OrderedDict()
+
+                group[text] = group.get(text, 0) + 1
+
+                if sum(group.values()) >= self.max_items:
+                    items = group
+                    self._groups[key] = None
+
+        if send_now:
+            self._send(key, text)
+        elif items:
+            self._send(key, self.format_digest(items))
+
+    def flush(self):
+        """Close all windows and send all pending digests"""
+        with self._lock:
+            groups = self._groups
+            self._groups = {}
+
+            for timer in self._timers.values():
+                timer.cancel()
+
+            self._timers.clear()
+
+        for key, items in groups.items():
+            if items:
+                self._send(key, self.format_digest(items))
+
+    def display_stats(self):
+        """Return aggregation statistics suitable for logging"""
+        if self.sent:
+            ratio = float(self.received) / self.sent
+        else:
+            ratio = 0.0
+
+        return 'window=%.1fs max_items=%d received=%d sent=%d ratio=%.2f pending=%d' % (
+            self.window, self.max_items, self.received, self.sent, ratio, len(self))
@@ -112,7 +112,7 @@ class Base(LudolphPlugin):
         return self._help_cache
 
     # noinspection PyUnusedLocal
-    @command
+    @command(priority='high')
     def help(self, msg, cmdstr=None):
         """
         Show this help.
@@ -122,7 +122,7 @@ class Base(LudolphPlugin):
         # Global help or command help?
         if cmdstr:
             xmpp = self.xmpp
-            cmd = xmpp.commands.get_command(cmdstr)
+            cmd = xmpp.commands.get_command(cmdstr, strict=True)
 
             if cmd:
                 # Remove whitespaces from __doc__ lines
@@ -133,7 +133,7 @@ class Base(LudolphPlugin):
         return self._help_all()
 
     # noinspection PyUnusedLocal
-    @command
+    @command(priority='high')
     def version(self, msg, plugin=None):
         """
         Display version of Ludolph or registered plugin.
@@ -151,7 +151,7 @@ class Base(LudolphPlugin):
         return '**Ludolph** version: %s' % self.get_version()
 
     # noinspection PyMethodMayBeStatic,PyUnusedLocal
-    @command
+    @command(priority='high')
     def about(self, msg):
         """
         Details about this project.
@@ -161,7 +161,7 @@ class Base(LudolphPlugin):
         return ABOUT.strip()
 
     # noinspection PyUnusedLocal
-    @command
+    @command(priority='high')
     def uptime(self, msg):
         """
         Show Ludolph uptime.
@@ -176,21 +176,69 @@ class Base(LudolphPlugin):
 
         return 'up %d days, %d hours, %d minutes, %d seconds' % (d, h, m, s)
 
-    def _message_send(self, jid, msg):
-        """Send new xmpp message. Used by message command and /message webhook"""
+    @command(priority='high')
+    def more(self, msg):
+        """
+        Show the next part of a long command output.
+
+        Usage: more
+        """
+        out = self.xmpp.msg_more(msg)
+
+        if out is None:
+            raise CommandError('Nothing more to show')
+
+        return out
+
+    # noinspection PyUnusedLocal
+    @command(admin_required=True)
+    def metrics(self, msg):
+        """
+        Show Ludolph runtime statistics (admin only).
+
+        Usage: metrics
+        """
+        return '\n'.join(self.xmpp.display_stats())
+
+    def _get_message_type(self, jid):
+        """Return message type suitable for JID or raise CommandError if JID is not in roster"""
         if jid == self.xmpp.room:
-            mtype = 'groupchat'
+            return 'groupchat'
         elif jid in self.xmpp.client_roster:
-            mtype = 'normal'
+            return 'normal'
         else:
             raise CommandError('User "%s" not in roster' % jid)
 
+    def _message_send(self, jid, msg):
+        """Send new xmpp message. Used by message command and /message webhook"""
+        mtype = self._get_message_type(jid)
         logger.info('Sending message to "%s"', jid)
         logger.debug('\twith body: "%s"', msg)
         self.xmpp.msg_send(jid, msg, mtype=mtype)
 
         return 'Message sent to **%s**' % jid
 
+    def _message_notify(self, jids, msg):
+        """Send new xmpp message to one or more users (and room). Used by /message webhook"""
+        users = []
+
+        for jid in jids:
+            if self._get_message_type(jid) == 'normal':
+                users.append(jid)
+
+        logger.info('Sending message to %s', ', '.join(jids))
+        logger.debug('\twith body: "%s"', msg)
+
+        if len(jids) != len(users):
+            self.xmpp.msg_notify(self.xmpp.room, msg, mtype='groupchat')
+
+        if len(users) == 1:
+            self.xmpp.msg_notify(users[0], msg, mtype='normal')
+        elif users:
+            self.xmpp.msg_notify(tuple(users), msg, mtype='normal')
+
+        return 'Message sent to %s' % ', '.join('**%s**' % jid for jid in jids)
+
     # noinspection PyUnusedLocal
     @command
     def message(self, msg, jid, text):
@@ -461,7 +509,7 @@ class Base(LudolphPlugin):
                 raise CommandError('Invalid date-time (required format: YYYY-mm-dd-HH-MM)')
 
         # Validate command
-        cmd = self.xmpp.commands.get_command(cmd_name)
+        cmd = self.xmpp.commands.get_command(cmd_name, strict=True)
 
         if not cmd:
             raise CommandError('Invalid command')
@@ -571,17 +619,24 @@ class Base(LudolphPlugin):
     @webhook('/message', methods=('POST',))
     def send_msg(self):
         """
-        Send xmpp message to user/room.
+        Send xmpp message to user/room. Multiple JIDs can be specified (comma-separated or repeated jid parameter).
         """
-        jid = request.forms.get('jid', None)
+        jids = []
 
-        if not jid:
+        for value in request.forms.getall('jid'):
+            for jid in value.split(','):
+                jid = jid.strip()
+
+                if jid and jid not in jids:
+                    jids.append(jid)
+
+        if not jids:
             abort(400, 'Missing JID in message request')
 
         msg = request.forms.get('msg', '')
 
         try:
-            return self._message_send(jid, msg)
+            return self._message_notify(jids, msg)
         except CommandError as e:
             abort(400, str(e))
 
@@ -596,4 +651,6 @@ class Base(LudolphPlugin):
             logger.warning('Missing msg parameter in broadcast request')
             abort(400, 'Missing msg parameter')
 
-        return 'Message sent (%dx)' % self.xmpp.msg_broadcast(msg)
+        self.xmpp.msg_notify(None, msg, mtype=None)
+
+        return 'Message sent (%dx)' % len(self.xmpp.get_broadcast_recipients())
@@ -26,6 +26,9 @@ COMMAND_FLAGS = {
     'admin_required': ('admin_required', True),
     'room_user_required': ('room_user_required', True),
     'room_admin_required': ('room_admin_required', True),
+    'high_priority': ('priority', 'high'),
+    'low_priority': ('priority', 'low'),
+    'coalesce': ('coalesce', True),
 }
 
 
@@ -171,7 +174,17 @@ class Commands(LudolphPlugin):
         logger.info('Running dynamic command: %s', cmd)
 
         try:
-            return Process(cmd).cmd_output(name, stream=msg.stream_output)
+            proc = Process(cmd)
+        except Exception as e:
+            raise CommandError('Could not run command (%s)' % e)
+
+        token = msg.cancel_token
+
+        if token:  # Kill the process when the command times out
+            token.add_callback(proc.terminate)
+
+        try:
+            return proc.cmd_output(name, stream=msg.stream_output)
         except CommandError:
             raise
         except Exception as e:
@@ -40,8 +40,8 @@ class Muc(LudolphPlugin):
             self.room_motd = self.config.get('motd', None)
 
         # Register event handlers for entering and leaving the MUC room
-        self.xmpp.register_event_handler('muc_user_online', self._room_joined)
-        self.xmpp.register_event_handler('muc_user_offline', self._room_left)
+        self.xmpp.register_event_handler('muc_user_online', self._room_joined, mutable=False)
+        self.xmpp.register_event_handler('muc_user_offline', self._room_left, mutable=False)
 
     def __destroy__(self):
         # Deregister event handlers for entering and leaving the MUC room
@@ -198,6 +198,6 @@ class Muc(LudolphPlugin):
             logger.warning('Missing msg parameter in room request')
             abort(400, 'Missing msg parameter')
 
-        self.xmpp.msg_send(self.xmpp.room, msg, mtype='groupchat')
+        self.xmpp.msg_notify(self.xmpp.room, msg, mtype='groupchat')
 
         return 'Message sent'
@@ -0,0 +1,160 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+import logging
+import time
+from threading import Lock
+
+__all__ = ('TokenBucket', 'RateLimiter')
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    Token bucket with capacity (burst size) and refill rate (tokens per second).
+    """
+    __slots__ = ('capacity', 'rate', 'tokens', 'timestamp')
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.timestamp = time.time()
+
+    def __repr__(self):
+        return '%s(%s/%s, rate=%s)' % (self.__class__.__name__, self.tokens, self.capacity, self.rate)
+
+    @classmethod
+    def parse(cls, value):
+        """Create bucket from string in "count/seconds" format"""
+        try:
+            count, seconds = value.split('/')
+            count, seconds = float(count), float(seconds)
+        except ValueError:
+            raise ValueError('Invalid rate limit "%s" (required format: count/seconds)' % value)
+
+        if count <= 0 or seconds <= 0:
+            raise ValueError('Invalid rate limit "%s" (count and seconds must be positive)' % value)
+
+        return cls(count, count / seconds)
+
+    def copy(self):
+        return self.__class__(self.capacity, self.rate)
+
+    def refill(self, now=None):
+        if now is None:
+            now = time.time()
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+        return self.tokens
+
+    def consume(self, tokens=1):
+        """Remove tokens from bucket. Return False if there are not enough tokens"""
+        if self.refill() < tokens:
+            return False
+
+        self.tokens -= tokens
+
+        return True
+
+    @property
+    def full(self):
+        return self.refill() >= self.capacity
+
+
+class RateLimiter(object):
+    """
+    Per-user, per-command and MUC room token buckets used for limiting the amount of processed commands.
+    """
+    max_buckets = 1000  # Idle (full) buckets are removed when the amount of buckets exceeds this number
+
+    def __init__(self, user=None, command=None, room=None, reply=True):
+        """The user, command and room parameters are bucket templates (or None if limiting is disabled)"""
+        self.limits = (('user', user), ('command', command), ('room', room))
+        self.reply = reply
+        self._buckets = {}  # (kind, key): bucket
+        self._limited = set()  # Users which were already informed that they are rate limited
+        self._lock = Lock()
+        self.allowed = 0
+        self.rejected = dict((kind, 0) for kind, _ in self.limits)
+
+    def __bool__(self):
+        return any(template for _, template in self.limits)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % i for i in self.limits if i[1]))
+
+    def _purge(self):
+        for key, bucket in tuple(self._buckets.items()):  # Copy for python 3
+            if bucket.full:
+                del self._buckets[key]
+
+    def _get_bucket(self, kind, key, template):
+        try:
+            return self._buckets[(kind, key)]
+        except KeyError:
+            if len(self._buckets) >= self.max_buckets:
+                self._purge()
+
+            bucket = self._buckets[(kind, key)] = template.copy()
+
+            return bucket
+
+    def check(self, user, command=None, room=None):
+        """
+        Consume one token from all relevant buckets and return None if the request is allowed.
+        Otherwise return the name of the exceeded limit (user, command or room).
+        """
+        keys = {'user': user, 'command': command, 'room': room}
+
+        with self._lock:
+            buckets = []
+
+            for kind, template in self.limits:
+                key = keys[kind]
+
+                if template and key:
+                    bucket = self._get_bucket(kind, key, template)
+
+                    if bucket.refill() < 1:
+                        self.rejected[kind] += 1
+                        return kind
+
+                    buckets.append(bucket)
+
+            for bucket in buckets:
+                bucket.tokens -= 1
+
+            self.allowed += 1
+            self._limited.discard(user)
+
+        return None
+
+    def notify(self, user):
+        """Return True if the user should be informed that the request was rejected (only once in a row)"""
+        if not self.reply:
+            return False
+
+        with self._lock:
+            if user in self._limited:
+                return False
+
+            self._limited.add(user)
+
+        return True
+
+    def display_stats(self):
+        """Return rate limiter statistics suitable for logging"""
+        return 'limits=[%s] allowed=%d rejected=[%s] buckets=%d' % (
+            ', '.join('%s=%g/%gs' % (kind, template.capacity, template.capacity / template.rate)
+                      for kind, template in self.limits if template),
+            self.allowed, ', '.join('%s=%d' % (kind, self.rejected[kind]) for kind, template in self.limits
+                                    if template), len(self._buckets))
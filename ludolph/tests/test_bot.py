@@ -0,0 +1,120 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+
+from ludolph.bot import LudolphBot
+from ludolph.command import (Command, CommandPermissions, CommandParameters, CommandParser, Commands, StreamBatch,
+                             PERM_USER)
+from ludolph.ratelimit import TokenBucket, RateLimiter
+from ludolph.utils import LRUCache
+
+
+class FakeStanza(dict):
+    def __init__(self, sent, **kwargs):
+        super(FakeStanza, self).__init__(**kwargs)
+        self.sent = sent
+
+    def __copy__(self):
+        return FakeStanza(self.sent, **self)
+
+    def reply(self, body, clear=True):
+        self['body'] = body
+
+    def send(self):
+        self.sent.append(self['body'])
+
+
+class FakePlugin(object):
+    def __init__(self):
+        self.calls = []
+
+    def help(self, msg):
+        self.calls.append(msg['from'])
+
+
+class FakeBot(LudolphBot):
+    permissions = {'a@b.c': PERM_USER}
+
+    # noinspection PyMissingConstructor
+    def __init__(self, message_max_size):
+        self.message_max_size = message_max_size
+        self.more_output = LRUCache(1048576)
+
+    # noinspection PyMethodMayBeStatic,PyUnusedLocal
+    def get_jid(self, msg, bare=True):
+        return msg.get('from', 'a@b.c')
+
+    def get_jid_permissions(self, jid):
+        return self.permissions.get(jid, 0)
+
+    # noinspection PyMethodMayBeStatic,PyUnusedLocal
+    def is_jid_xhtml_capable(self, jid, mtype=None):
+        return False
+
+    # noinspection PyMethodMayBeStatic
+    def send_stanza(self, stanza, priority=False):
+        return stanza.send()
+
+
+class LudolphBotReplyTest(unittest.TestCase):
+
+    def test_paginate(self):
+        sent = []
+        bot = FakeBot(100)
+        msg = FakeStanza(sent, type='chat', to='a@b.c')
+        bot.msg_reply(msg, '\n'.join('line %02d' % i for i in range(60)))
+        self.assertEqual(len(sent), 1)
+        self.assertTrue(bot.more_output.get('a@b.c'))
+        bot.msg_reply(msg, 'short')  # Short replies keep the more buffer
+        self.assertTrue(bot.more_output.get('a@b.c'))
+
+    def test_stream_batches(self):
+        sent = []
+        bot = FakeBot(100)
+        msg = FakeStanza(sent, type='chat', to='a@b.c')
+        lines = ['line %02d' % i for i in range(60)]
+        batch = StreamBatch(lambda text: bot.msg_reply(msg, text, preserve_msg=True, paginate=False),
+                            interval=0, lines=50, size=4096)
+
+        for line in lines:
+            batch.add(line)
+
+        batch.flush()
+        self.assertEqual('\n'.join(sent).split('\n'), lines)  # Every part of every batch was sent
+        self.assertTrue(all(len(text) <= 100 for text in sent))
+        self.assertEqual(bot.more_output.get('a@b.c'), None)
+        self.assertEqual(msg.get('body'), None)
+
+
+class LudolphBotRateLimitTest(unittest.TestCase):
+
+    def test_unauthorized(self):
+        sent = []
+        plugin = FakePlugin()
+        perms = CommandPermissions(True, False, False, False)
+        fun_spec = CommandParameters(0, 0, False)
+        bot = FakeBot(0)
+        bot.room = None
+        bot.plugins = {'ludolph.plugins.test': plugin}
+        bot.commands = Commands()
+        bot.commands['help'] = Command('help', 'help', 'ludolph.plugins.test', '', perms, fun_spec, 'normal',
+                                       CommandParser(fun_spec), PERM_USER)
+        bot.ratelimit = RateLimiter(command=TokenBucket(1, 0.001))
+
+        for jid in ('x@b.c', 'y@b.c', 'a@b.c', 'a@b.c'):
+            bot._run_command(FakeStanza(sent, type='chat', body='help', to=jid, **{'from': jid}))
+
+        # The commands bucket is not spent by users without permissions to run the command
+        self.assertEqual(plugin.calls, ['x@b.c', 'y@b.c', 'a@b.c'])
+        self.assertEqual(bot.ratelimit.rejected['command'], 1)
+        self.assertEqual(len(sent), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
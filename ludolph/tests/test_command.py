@@ -0,0 +1,241 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import time
+import threading
+import unittest
+from ludolph.command import (Command, CommandPermissions, CommandParameters, CommandParser, Commands, PrefixIndex,
+                             CommandError, MissingParameter, AmbiguousCommand, CommandTimeout, run_with_timeout,
+                             StreamBatch,
+                             get_permissions_mask, PERM_USER, PERM_ADMIN, PERM_ROOM_USER, PERM_ROOM_ADMIN)
+from ludolph.plugins.commands import Process
+
+
+def make_command(name, module='ludolph.plugins.test'):
+    perms = CommandPermissions(True, False, False, False)
+    fun_spec = CommandParameters(0, 0, False)
+
+    return Command(name, name.replace('-', '_'), module, '', perms, fun_spec, 'normal', CommandParser(fun_spec),
+                   get_permissions_mask(perms))
+
+
+class FakePermissionsBot(object):
+    permissions = {'admin@b.c': PERM_USER | PERM_ADMIN, 'user@b.c': PERM_USER | PERM_ROOM_USER}
+
+    def get_jid_permissions(self, jid):
+        return self.permissions.get(jid, 0)
+
+
+class LudolphCommandPermissionsTest(unittest.TestCase):
+
+    def test_get_permissions_mask(self):
+        self.assertEqual(get_permissions_mask(CommandPermissions(True, False, False, False)), PERM_USER)
+        self.assertEqual(get_permissions_mask(CommandPermissions(False, True, False, True)),
+                         PERM_ADMIN | PERM_ROOM_ADMIN)
+
+    def test_is_jid_permitted_to_run(self):
+        xmpp = FakePermissionsBot()
+        cmd = make_command('test')._replace(perms_mask=PERM_USER | PERM_ADMIN)
+        self.assertTrue(cmd.is_jid_permitted_to_run(xmpp, 'admin@b.c'))
+        self.assertFalse(cmd.is_jid_permitted_to_run(xmpp, 'user@b.c'))
+        self.assertFalse(cmd.is_jid_permitted_to_run(xmpp, 'nobody@b.c'))
+
+
+class LudolphPrefixIndexTest(unittest.TestCase):
+
+    def test_find(self):
+        index = PrefixIndex(['help', 'hosts', 'host-groups', 'uptime'])
+        self.assertEqual(index.find('h'), ['help', 'host-groups', 'hosts'])
+        self.assertEqual(index.find('host'), ['host-groups', 'hosts'])
+        self.assertEqual(index.find('x'), [])
+        self.assertEqual(index.first('ho'), 'host-groups')
+        self.assertEqual(index.first('u'), 'uptime')
+        self.assertEqual(index.first('x'), None)
+
+    def test_remove(self):
+        index = PrefixIndex(['host', 'hosts'])
+        index.remove('hosts')
+        self.assertEqual(index.find('h'), ['host'])
+        index.remove('host')
+        self.assertEqual(index.find('h'), [])
+        self.assertEqual(index.children, {})
+
+
+class LudolphCommandParserTest(unittest.TestCase):
+
+    def test_tokenize(self):
+        tokenize = CommandParser.tokenize
+        self.assertEqual(tokenize('a  b c'), ['a', 'b', 'c'])
+        self.assertEqual(tokenize('a  b   c', maxsplit=1), ['a', 'b   c'])
+        self.assertEqual(tokenize('a "b c" d'), ['a', 'b c', 'd'])
+        self.assertEqual(tokenize('a \'b "c\' x"y\\"z"'), ['a', 'b "c', 'xy"z'])
+        self.assertEqual(tokenize('a "b c" "d  e"', maxsplit=2), ['a', 'b c', '"d  e"'])
+        self.assertEqual(tokenize('a "b c'), ['a', '"b', 'c'])  # Unbalanced quotes
+
+    def test_parse_no_args(self):
+        self.assertEqual(CommandParser(CommandParameters(0, 0, False)).parse('cmd a b'), [])
+
+    def test_parse_required(self):
+        parser = CommandParser(CommandParameters(2, 0, False))
+        self.assertEqual(parser.parse('message a@b.c hello'), ['a@b.c', 'hello'])
+        self.assertEqual(parser.parse('message a@b.c "hello world"'), ['a@b.c', 'hello world'])
+        self.assertEqual(parser.parse('message a@b.c hello  "big" world'), ['a@b.c', 'hello  "big" world'])
+        self.assertRaises(MissingParameter, parser.parse, 'message a@b.c')
+        self.assertRaises(MissingParameter, parser.parse, 'message "" hello')
+
+    def test_parse_optional(self):
+        parser = CommandParser(CommandParameters(0, 2, False))
+        self.assertEqual(parser.parse('roster'), [])
+        self.assertEqual(parser.parse('roster del'), ['del'])
+        self.assertEqual(parser.parse('roster del a@b.c'), ['del', 'a@b.c'])
+
+    def test_parse_star_args(self):
+        parser = CommandParser(CommandParameters(0, 0, True))
+        self.assertEqual(parser.parse('at add +5 "uptime now"'), ['add', '+5', 'uptime now'])
+
+    def test_parse_types(self):
+        parser = CommandParser(CommandParameters(1, 1, True), names=('count', 'name'), star_name='rest',
+                               types={'count': int, 'rest': int})
+        self.assertEqual(parser.parse('cmd 1 a 2 3'), [1, 'a', 2, 3])
+        self.assertRaises(CommandError, parser.parse, 'cmd x')
+
+
+class LudolphCommandsLookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = Commands()
+
+        for name in ('help', 'hosts', 'host-groups', 'uptime'):
+            self.commands[name] = make_command(name)
+
+    def test_get_command(self):
+        self.assertEqual(self.commands.get_command('HOSTS').name, 'hosts')
+        self.assertEqual(self.commands.get_command('hos').name, 'host-groups')
+        self.assertEqual(self.commands.get_command('up').name, 'uptime')
+        self.assertEqual(self.commands.get_command('x'), None)
+        self.assertEqual(self.commands.get_command(''), None)
+
+    def test_get_command_strict(self):
+        self.assertEqual(self.commands.get_command('he', strict=True).name, 'help')
+        self.assertEqual(self.commands.get_command('hosts', strict=True).name, 'hosts')
+
+        with self.assertRaises(AmbiguousCommand) as ctx:
+            self.commands.get_command('ho', strict=True)
+
+        self.assertEqual(ctx.exception.matches, ['host-groups', 'hosts'])
+
+    def test_reset_results_cache(self):
+        self.commands.results.set(('ludolph.plugins.test', 'hosts', (), None), 'out')
+        self.commands.results.set(('ludolph.plugins.other', 'hosts', (), None), 'out')
+        self.assertEqual(self.commands.results.size, 6)  # Length of cached outputs
+        self.commands.reset(module='ludolph.plugins.test')
+        self.assertEqual(len(self.commands.results), 1)
+        self.commands.reset()
+        self.assertEqual(len(self.commands.results), 0)
+
+    def test_pop_and_reset(self):
+        self.commands.pop('host-groups')
+        self.assertEqual(self.commands.get_command('hos').name, 'hosts')
+        self.commands.reset()
+        self.assertEqual(self.commands.get_command('h'), None)
+
+
+class FakeMessage(dict):
+    cancel_token = None
+
+
+class LudolphCommandTimeoutTest(unittest.TestCase):
+
+    def test_run_with_timeout(self):
+        msg = FakeMessage(body='test')
+        self.assertEqual(run_with_timeout(5, msg, None, lambda x: x, 'out'), 'out')
+        self.assertRaises(ZeroDivisionError, run_with_timeout, 5, msg, None, lambda: 1 / 0)
+
+    def test_timeout(self):
+        msg = FakeMessage(body='test')
+        cancelled = []
+        replies = []
+
+        def fun():
+            msg.cancel_token.add_callback(lambda: cancelled.append(True))
+            msg.cancel_token.wait(5)
+            self.assertEqual(replies, ['ERROR: Command timed out after 0.01 seconds'])  # Sent by the watchdog
+
+        self.assertRaises(CommandTimeout, run_with_timeout, 0.01, msg, replies.append, fun)
+        self.assertTrue(msg.cancel_token.cancelled)
+        self.assertEqual(cancelled, [True])
+        self.assertEqual(len(replies), 1)
+
+    def test_terminated_process(self):
+        msg = FakeMessage(body='sleep 5')
+        start = time.time()
+
+        def fun():
+            proc = Process(['sleep', '5'])
+            msg.cancel_token.add_callback(proc.terminate)
+            return proc.cmd_output('sleep')  # Raises CommandError for the non-zero exit code
+
+        with self.assertRaises(CommandTimeout) as ctx:
+            run_with_timeout(0.2, msg, None, fun)
+
+        self.assertEqual(str(ctx.exception), 'ERROR: Command timed out after 0.2 seconds')
+        self.assertLess(time.time() - start, 5)
+
+    def test_same_thread(self):
+        msg = FakeMessage(body='test')
+        self.assertIs(run_with_timeout(5, msg, None, threading.current_thread), threading.current_thread())
+
+
+class LudolphStreamBatchTest(unittest.TestCase):
+
+    def test_lines(self):
+        sent = []
+        batch = StreamBatch(sent.append, interval=0, lines=2, size=1000)
+
+        for line in ('a', 'b', 'c', 'd'):
+            batch.add(line)
+
+        self.assertEqual(sent, ['a', 'b\nc'])  # The first line is sent immediately
+        batch.flush()
+        self.assertEqual(sent, ['a', 'b\nc', 'd'])
+        self.assertEqual((batch.lines, batch.messages), (4, 3))
+
+    def test_size(self):
+        sent = []
+        batch = StreamBatch(sent.append, interval=0, lines=100, size=8)
+
+        for line in ('first', 'abc', 'def', 'ghi'):
+            batch.add(line)
+
+        batch.flush()
+        self.assertEqual(sent, ['first', 'abc\ndef', 'ghi'])
+
+    def test_interval(self):
+        sent = []
+        batch = StreamBatch(sent.append, interval=0.01, lines=100, size=1000)
+        batch.add('a')
+        batch.add('b')
+        self.assertEqual(sent, ['a'])
+
+        for _ in range(500):
+            if len(sent) > 1:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(sent, ['a', 'b'])
+
+    def test_disabled(self):
+        sent = []
+        batch = StreamBatch(sent.append, interval=1, lines=1)
+        batch.add('a')
+        batch.add('b')
+        self.assertEqual(sent, ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from threading import Event
+
+from ludolph.dispatcher import Dispatcher, Lane
+
+
+class LudolphDispatcherTest(unittest.TestCase):
+
+    def test_submit(self):
+        done = Event()
+        result = []
+
+        def job(value):
+            result.append(value)
+            done.set()
+
+        dispatcher = Dispatcher(2)
+        dispatcher.start()
+
+        try:
+            self.assertTrue(dispatcher.submit(job, 'test'))
+            self.assertTrue(done.wait(5))
+            self.assertEqual(result, ['test'])
+        finally:
+            dispatcher.stop()
+
+    def test_lanes(self):
+        dispatcher = Dispatcher(1, lanes={'high': 1, 'low': 0})
+        self.assertEqual(list(dispatcher.lanes.keys()), ['high', 'normal'])
+        self.assertTrue(dispatcher.submit_to('high', len, 'a'))
+        self.assertTrue(dispatcher.submit_to('low', len, 'b'))  # No workers -> default lane
+        self.assertEqual(dispatcher.lanes['high'].submitted, 1)
+        self.assertEqual(dispatcher.lanes['normal'].submitted, 1)
+
+    def test_overflow_drop(self):
+        lane = Lane('test', 1, queue_size=1, overflow='drop')  # Not started -> nobody drains the queue
+        self.assertTrue(lane.put(len, ('a',)))
+        self.assertFalse(lane.put(len, ('b',)))
+        self.assertEqual(lane.dropped, 1)
+
+    def test_overflow_drop_oldest(self):
+        lane = Lane('test', 1, queue_size=1, overflow='drop_oldest')
+        self.assertTrue(lane.put(len, ('a',)))
+        self.assertTrue(lane.put(len, ('b',)))
+        self.assertEqual(lane.dropped, 1)
+        self.assertEqual(lane.queue.get_nowait()[2], ('b',))
+
+    def test_invalid_overflow(self):
+        self.assertRaises(ValueError, Lane, 'test', 1, overflow='invalid')
+        self.assertRaises(ValueError, Lane, 'test', 1, overflow='block')
+
+
+if __name__ == '__main__':
+    unittest.main()
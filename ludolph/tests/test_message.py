@@ -0,0 +1,236 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from copy import copy
+from xml.etree import ElementTree as ET
+
+from sleekxmpp.stanza import Message
+
+from ludolph.message import (render_markup as _render_markup, red, split_markup, OutgoingLudolphMessage,
+                             IncomingLudolphMessage, StanzaView)
+
+
+def render_markup(text):
+    body, html = _render_markup(text)
+
+    return body, ET.tostring(html).decode('utf-8')[len('<div>\n'):-len('\n</div>')]
+
+
+class LudolphMessageRenderTest(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual(render_markup('a < b\nc'), ('a < b\nc', 'a &lt; b<br />\nc'))
+
+    def test_markup(self):
+        self.assertEqual(render_markup('**a** __b__ ^^c^^ ~~d~~'),
+                         ('*a* b c d', '<b>a</b> <i>b</i> <sup>c</sup> <sub>d</sub>'))
+        self.assertEqual(render_markup('[[http://a/?b&c|**link**]]'),
+                         ('http://a/?b&c', '<a href="http://a/?b&amp;c"><b>link</b></a>'))
+        self.assertEqual(render_markup('**a\nb**'), ('**a\nb**', '**a<br />\nb**'))  # Markup is not multi-line
+
+    def test_span(self):
+        self.assertEqual(render_markup(red('a') + ' ' + red('b')),
+                         ('a b', '<span style="color:#FF0000">a</span> <span style="color:#FF0000">b</span>'))
+
+    def test_keywords(self):
+        self.assertEqual(render_markup('ERROR')[1], '<span style="color:#FF0000;">ERROR</span>')
+        self.assertEqual(render_markup('**PROBLEM**: high')[1],
+                         '<b><span style="color:#FF0000;"><strong>PROBLEM</strong></span></b>: '
+                         '<span style="color:#FF6600;"><strong>high</strong></span>')
+        self.assertEqual(render_markup('[[http://a/OK|x]]')[1], '<a href="http://a/OK">x</a>')
+
+    def test_crossing_markup(self):
+        self.assertEqual(render_markup('**a __b** c__'), ('*a __b* c__', '<b>a __b</b> c__'))
+        self.assertEqual(render_markup('[[http://a/"x"|t]]')[1], '<a href="http://a/&quot;x&quot;">t</a>')
+
+
+class LudolphMessageSplitTest(unittest.TestCase):
+
+    def test_split_lines(self):
+        self.assertEqual(split_markup('aaa\nbbb\nccc', 7), ['aaa\nbbb', 'ccc'])
+        self.assertEqual(split_markup('aaa\nbbb', 10), ['aaa\nbbb'])
+
+    def test_split_long_line(self):
+        self.assertEqual(split_markup('**bold text** and more words', 15), ['**bold text** ', 'and more words'])
+        self.assertEqual(split_markup('x' * 25, 10), ['x' * 10, 'x' * 10, 'x' * 5])
+
+    def test_split_message(self):
+        msg = OutgoingLudolphMessage('line 1\nline 2\nline 3', mtype='chat')
+        parts = msg.split(10, suffix='\n...')
+        self.assertEqual([i.text for i in parts], ['line 1\n...', 'line 2\n...', 'line 3'])
+        self.assertEqual(parts[0].mtype, 'chat')
+        self.assertEqual(msg.split(100), [msg])
+
+
+class LudolphMessageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = OutgoingLudolphMessage.render_cache
+        self.cache.clear()
+
+    def tearDown(self):
+        self.cache.max_size = OutgoingLudolphMessage.render_cache_size
+        self.cache.clear()
+
+    def test_cache(self):
+        msg1 = OutgoingLudolphMessage('**PROBLEM**')
+        msg2 = OutgoingLudolphMessage(' **PROBLEM** ')
+        self.assertIsNot(msg1.mhtml, msg2.mhtml)  # Every message gets a copy of the cached html template
+        self.assertEqual(ET.tostring(msg1.mhtml), ET.tostring(msg2.mhtml))
+        self.assertEqual(msg1.mbody, msg2.mbody)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_cache_disabled(self):
+        self.cache.max_size = 0
+        self.assertEqual(OutgoingLudolphMessage('test').mbody, 'test')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lazy_html(self):
+        msg = OutgoingLudolphMessage('**lazy**')
+        self.assertEqual(msg.mbody, '*lazy*')
+        self.assertEqual(self.cache.get('**lazy**'), ('*lazy*', None))  # The html part was not rendered
+        self.assertEqual(ET.tostring(msg.mhtml), b'<div>\n<b>lazy</b>\n</div>')
+
+
+class FakeClient(object):
+    sent = None
+
+    created = 0
+
+    def make_message(self, mto, mbody, mhtml=None, **kwargs):
+        self.sent = (mto, mbody, mhtml)
+        self.created += 1
+
+        return FakeStanza(to=mto, body=mbody, html=mhtml)
+
+
+class FakeAddresses(list):
+    def add_address(self, atype='to', jid=''):
+        self.append((atype, jid))
+
+
+class FakeSubStanza(dict):
+    xml = None
+
+    def __copy__(self):
+        return FakeSubStanza(self)
+
+
+class FakeStanza(dict):
+    def __missing__(self, key):
+        if key == 'addresses':
+            value = self[key] = FakeAddresses()
+            return value
+
+        raise KeyError(key)
+
+    def __copy__(self):  # Sub-stanzas are copied as well (like ElementBase.__copy__ copies the XML tree)
+        return FakeStanza((k, copy(v)) for k, v in self.items())
+
+    def send(self):
+        return True
+
+
+class FakeXMPP(object):
+    def __init__(self, xhtml):
+        self.xhtml = xhtml
+        self.client = FakeClient()
+
+    def is_jid_xhtml_capable(self, jid, mtype=None):
+        return self.xhtml
+
+    # noinspection PyMethodMayBeStatic
+    def send_stanza(self, stanza, priority=False):
+        return stanza.send()
+
+
+class LudolphMessageSendTest(unittest.TestCase):
+
+    def test_send_xhtml(self):
+        xmpp = FakeXMPP(True)
+        OutgoingLudolphMessage('**a**').send(xmpp, 'a@b.c')
+        self.assertEqual(xmpp.client.sent[:2], ('a@b.c', '*a*'))
+        self.assertEqual(ET.tostring(xmpp.client.sent[2]), b'<div>\n<b>a</b>\n</div>')
+
+    def test_send_plain(self):
+        xmpp = FakeXMPP(False)
+        OutgoingLudolphMessage('**a**').send(xmpp, 'a@b.c')
+        self.assertEqual(xmpp.client.sent, ('a@b.c', '*a*', None))
+
+    def test_fan_out(self):
+        xmpp = FakeXMPP(True)
+        stanzas = OutgoingLudolphMessage('**a**').fan_out(xmpp, ['a@b.c', 'b@b.c', 'c@b.c'])
+        self.assertEqual(xmpp.client.created, 1)  # The stanza is created only once
+        self.assertEqual([stanza['to'] for stanza in stanzas], ['a@b.c', 'b@b.c', 'c@b.c'])
+        self.assertEqual(set(stanza['body'] for stanza in stanzas), {'*a*'})
+
+    def test_multicast(self):
+        xmpp = FakeXMPP(True)
+        res = OutgoingLudolphMessage('**a**').multicast(xmpp, 'b.c', ['a@b.c', 'b@b.c', 'c@b.c'], max_recipients=2)
+        self.assertEqual(xmpp.client.created, 1)
+        self.assertEqual([jids for _, jids in res], [['a@b.c', 'b@b.c'], ['c@b.c']])
+        self.assertEqual([stanza['to'] for stanza, _ in res], ['b.c', 'b.c'])
+        self.assertEqual(res[0][0]['addresses'], [('bcc', 'a@b.c'), ('bcc', 'b@b.c')])
+        self.assertEqual(res[1][0]['addresses'], [('bcc', 'c@b.c')])
+
+
+class LudolphIncomingMessageTest(unittest.TestCase):
+
+    def test_wrap_msg(self):
+        msg1, msg2 = Message(), Message()
+        wrapped1 = IncomingLudolphMessage.wrap_msg(msg1)
+        wrapped2 = IncomingLudolphMessage.wrap_msg(msg2)
+        self.assertIs(type(wrapped1), type(wrapped2))  # The subclass is created only once
+        self.assertEqual(type(wrapped1).__name__, 'Message')
+        self.assertIsInstance(wrapped1, Message)
+        self.assertIs(wrapped1.__dict__, msg1.__dict__)
+        wrapped1.stream_output = True
+        self.assertTrue(wrapped1.stream_output)
+        self.assertFalse(wrapped2.stream_output)
+        self.assertRaises(TypeError, IncomingLudolphMessage.wrap_msg, wrapped1)
+
+
+class LudolphStanzaViewTest(unittest.TestCase):
+
+    def test_read_only(self):
+        stanza = FakeStanza(body='hello')
+        view = StanzaView(stanza)
+        self.assertEqual(view['body'], 'hello')
+        self.assertEqual(view.get('body'), 'hello')
+        self.assertIsInstance(view, FakeStanza)
+        self.assertRaises(TypeError, view.__setitem__, 'body', 'changed')
+        self.assertRaises(TypeError, setattr, view, 'stream_output', True)
+        self.assertEqual(stanza, {'body': 'hello'})
+
+    def test_read_only_sub_stanza(self):
+        stanza = FakeStanza(body='hello', muc=FakeSubStanza(nick='user'))
+        view = StanzaView(stanza)
+        self.assertEqual(view['muc']['nick'], 'user')
+        self.assertRaises(TypeError, view['muc'].__setitem__, 'nick', 'changed')
+        self.assertEqual(stanza['muc']['nick'], 'user')
+
+    def test_copy_on_write_sub_stanza(self):
+        stanza = FakeStanza(body='hello', muc=FakeSubStanza(nick='user'))
+        view = StanzaView(stanza, mutable=True)
+        view['muc']['nick'] = 'changed'
+        self.assertEqual(view['muc']['nick'], 'changed')
+        self.assertEqual(stanza['muc']['nick'], 'user')
+
+    def test_copy_on_write(self):
+        stanza = FakeStanza(body='hello')
+        view = StanzaView(stanza, mutable=True)
+        self.assertEqual(view['body'], 'hello')
+        self.assertIs(view._copy, None)  # Nothing was copied yet
+        view['body'] = 'changed'
+        self.assertEqual(view['body'], 'changed')
+        self.assertEqual(stanza['body'], 'hello')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import time
+import unittest
+from threading import Event
+
+from ludolph.outbox import SendQueue, Aggregator
+
+
+class FakeStanza(object):
+    def __init__(self, name, sent, done=None):
+        self.name = name
+        self.sent = sent
+        self.done = done
+
+    def __str__(self):
+        return '<message>%s</message>' % self.name
+
+    def send(self):
+        self.sent.append(self.name)
+
+        if self.done:
+            self.done.set()
+
+
+class LudolphSendQueueTest(unittest.TestCase):
+
+    def test_send(self):
+        sent = []
+        done = Event()
+        outbox = SendQueue(rate=1000, byte_rate=100000, burst=10)
+        outbox.start()
+
+        try:
+            outbox.put(FakeStanza('a', sent))
+            outbox.put(FakeStanza('b', sent, done))
+            self.assertTrue(done.wait(5))
+        finally:
+            outbox.stop()
+
+        self.assertEqual(sent, ['a', 'b'])
+        self.assertEqual(outbox.sent, 2)
+        self.assertEqual(outbox.sent_bytes, 40)
+
+    def test_priority(self):
+        sent = []
+        done = Event()
+        outbox = SendQueue(rate=1000)  # Not started -> stanzas are waiting in queues
+        outbox.put(FakeStanza('normal', sent))
+        outbox.put(FakeStanza('high', sent), priority=True)
+        outbox.put(FakeStanza('last', sent, done))
+        self.assertEqual(len(outbox), 3)
+        self.assertEqual(outbox.max_depth, 3)
+        outbox.start()
+
+        try:
+            self.assertTrue(done.wait(5))
+        finally:
+            outbox.stop()
+
+        self.assertEqual(sent, ['high', 'normal', 'last'])
+
+    def test_put_many(self):
+        sent = []
+        outbox = SendQueue()
+        outbox.put_many([FakeStanza(name, sent) for name in ('a', 'b', 'c')])
+        self.assertEqual(len(outbox), 3)
+        self.assertEqual([job[1].name for job in outbox.lanes[1][1]], ['a', 'b', 'c'])
+
+    def test_rate(self):
+        outbox = SendQueue(rate=10, burst=2)
+        self.assertEqual(outbox.messages.capacity, 2)
+        self.assertEqual(outbox.bytes, None)
+        self.assertEqual(SendQueue(rate=10, byte_rate=1000, burst=5).bytes.capacity, 500)
+
+    def test_stop_drain(self):
+        sent = []
+        outbox = SendQueue(rate=0.001, burst=1)
+        outbox.put(FakeStanza('normal', sent))
+        outbox.put_many([FakeStanza(name, sent) for name in ('a', 'b', 'c')], priority=True)
+        outbox.start()
+        outbox.stop()
+        self.assertEqual(sent, ['a', 'b', 'c'])
+        self.assertEqual(len(outbox), 1)
+
+
+class LudolphAggregatorTest(unittest.TestCase):
+
+    def test_max_items(self):
+        sent = []
+        aggregator = Aggregator(lambda key, text: sent.append((key, text)), window=60, max_items=3)
+
+        for text in ('first', 'a', 'b', 'a', 'c'):
+            aggregator.add('x@b.c', text)
+
+        aggregator.add('y@b.c', 'other')
+        self.assertEqual(sent, [('x@b.c', 'first'), ('x@b.c', 'a (2x)\nb'), ('y@b.c', 'other')])
+        self.assertEqual(len(aggregator), 1)
+        aggregator.flush()
+        self.assertEqual(sent[-1], ('x@b.c', 'c'))
+        self.assertEqual((aggregator.received, aggregator.sent), (6, 4))
+
+    def test_window(self):
+        sent = []
+        aggregator = Aggregator(lambda key, text: sent.append(text), window=0.01, max_items=100)
+        aggregator.add('x@b.c', 'first')
+        aggregator.add('x@b.c', 'second')
+        aggregator.add('x@b.c', 'second')
+        self.assertEqual(sent, ['first'])
+
+        for _ in range(500):
+            if len(sent) > 1:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(sent, ['first', 'second (2x)'])
+        aggregator.flush()
+
+
+if __name__ == '__main__':
+    unittest.main()
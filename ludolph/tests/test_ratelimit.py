@@ -0,0 +1,52 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import unittest
+from ludolph.ratelimit import TokenBucket, RateLimiter
+
+
+class LudolphTokenBucketTest(unittest.TestCase):
+
+    def test_parse(self):
+        bucket = TokenBucket.parse('10/20')
+        self.assertEqual((bucket.capacity, bucket.rate), (10, 0.5))
+        self.assertRaises(ValueError, TokenBucket.parse, '10')
+        self.assertRaises(ValueError, TokenBucket.parse, '0/10')
+
+    def test_consume(self):
+        bucket = TokenBucket(2, 0.0001)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+
+class LudolphRateLimiterTest(unittest.TestCase):
+
+    def test_check(self):
+        limiter = RateLimiter(user=TokenBucket(2, 0.0001), command=TokenBucket(3, 0.0001))
+        self.assertEqual(limiter.check('a@b.c', command='help'), None)
+        self.assertEqual(limiter.check('a@b.c', command='help'), None)
+        self.assertEqual(limiter.check('a@b.c', command='help'), 'user')
+        self.assertEqual(limiter.check('x@b.c', command='help'), None)
+        self.assertEqual(limiter.check('x@b.c', command='help'), 'command')
+        self.assertEqual(limiter.check('x@b.c', command='uptime'), None)
+        self.assertEqual(limiter.allowed, 4)
+        self.assertEqual(limiter.rejected, {'user': 1, 'command': 1, 'room': 0})
+
+    def test_notify(self):
+        limiter = RateLimiter(user=TokenBucket(1, 0.0001))
+        self.assertTrue(limiter.notify('a@b.c'))
+        self.assertFalse(limiter.notify('a@b.c'))
+        self.assertFalse(RateLimiter(user=TokenBucket(1, 1), reply=False).notify('a@b.c'))
+
+    def test_disabled(self):
+        self.assertFalse(RateLimiter())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import re
+import time
+import unittest
+from threading import Thread, Event
+from ludolph.utils import LRUCache, SingleFlight, PatternMatcher
+
+
+class LudolphLRUCacheTest(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(10, sizeof=len)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        self.assertEqual(cache.get('a'), 'xxxx')  # a is now the most recently used item
+        cache.set('c', 'xxxx')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'xxxx')
+        self.assertEqual(cache.size, 8)
+        self.assertFalse(cache.set('d', 'x' * 11))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_ttl(self):
+        cache = LRUCache(100, sizeof=len)
+        cache.set('a', 'x', ttl=0.01)
+        cache.set('b', 'x')
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 'x')
+        self.assertEqual(cache.size, 1)
+
+    def test_invalidate(self):
+        cache = LRUCache(100, sizeof=len)
+        cache.set(('mod1', 'a'), 'x')
+        cache.set(('mod2', 'a'), 'x')
+        cache.invalidate(lambda key: key[0] == 'mod1')
+        self.assertNotIn(('mod1', 'a'), cache)
+        self.assertIn(('mod2', 'a'), cache)
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class LudolphSingleFlightTest(unittest.TestCase):
+
+    def test_do(self):
+        flight = SingleFlight()
+        started = Event()
+        release = Event()
+        calls = []
+        results = []
+
+        def fun():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'out'
+
+        leader = Thread(target=lambda: results.append(flight.do('key', fun)))
+        leader.start()
+        started.wait(5)
+        followers = [Thread(target=lambda: results.append(flight.do('key', fun))) for _ in range(3)]
+
+        for i in followers:
+            i.start()
+
+        while flight.collapsed < 3:
+            time.sleep(0.001)
+
+        release.set()
+
+        for i in [leader] + followers:
+            i.join(5)
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['out'] * 4)
+        self.assertEqual((flight.executed, flight.collapsed), (1, 3))
+        self.assertEqual(flight.do('key', lambda: 'new'), 'new')
+
+    def test_do_error(self):
+        flight = SingleFlight()
+        self.assertRaises(ZeroDivisionError, flight.do, 'key', lambda: 1 / 0)
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+
+
+class LudolphPatternMatcherTest(unittest.TestCase):
+
+    def test_match(self):
+        matcher = PatternMatcher([re.compile('foo'), re.compile(r'\bdisk (full|error)'), re.compile('^ping$')])
+        self.assertEqual(matcher.separate, [])
+        self.assertEqual(matcher.match('foo: disk full'), [0, 1])
+        self.assertEqual(matcher.match('ping'), [2])
+        self.assertEqual(matcher.match('nothing\nhere'), [])
+
+    def test_overlapping(self):
+        matcher = PatternMatcher([re.compile('disk'), re.compile('disk full'), re.compile('full')])
+        self.assertEqual(matcher.match('disk full'), [0, 1, 2])
+
+    def test_separate(self):
+        matcher = PatternMatcher([re.compile(r'(a)\1'), re.compile('bar', re.I), re.compile('baz')])
+        self.assertEqual(matcher.separate, [0, 1])
+        self.assertEqual(matcher.match('aa BAR baz'), [0, 1, 2])
+        self.assertEqual(matcher.match('a bar'), [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Ludolph: Monitoring Jabber Bot
+Copyright (C) 2017 Erigones, s. r. o.
+This file is part of Ludolph.
+
+See the LICENSE file for copying permission.
+"""
+
+import os
+import unittest
+
+from ludolph.web import BlobStore
+
+
+class LudolphBlobStoreTest(unittest.TestCase):
+
+    def test_memory(self):
+        blobs = BlobStore(max_memory=100)
+        token = blobs.add('output')
+        self.assertEqual(len(token), 32)
+        self.assertEqual(blobs.memory, 6)
+        self.assertEqual(blobs.get(token), b'output')
+        self.assertEqual(blobs.get(token), None)  # One-time access
+        self.assertEqual(blobs.memory, 0)
+
+    def test_spill(self):
+        blobs = BlobStore(max_memory=10)
+        blobs.add('small')
+        token = blobs.add('large output')
+        path = blobs._blobs[token][1]
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(blobs.spilled, 1)
+        self.assertEqual(blobs.get(token), b'large output')
+        self.assertFalse(os.path.exists(path))
+
+    def test_not_once(self):
+        blobs = BlobStore(max_memory=0)
+        token = blobs.add('output', once=False)
+        self.assertEqual(blobs.get(token), b'output')
+        self.assertEqual(blobs.get(token), b'output')
+        self.assertEqual(blobs.served, 2)
+        self.assertEqual(len(blobs), 1)
+
+    def test_expired(self):
+        blobs = BlobStore(ttl=-1)
+        token = blobs.add('output')
+        self.assertEqual(blobs.get(token), None)
+        self.assertEqual(blobs.expired, 1)
+
+    def test_clear(self):
+        blobs = BlobStore(max_memory=0)
+        token = blobs.add('output')
+        path = blobs._blobs[token][1]
+        blobs.clear()
+        self.assertEqual(len(blobs), 0)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,8 +5,18 @@ This file is part of Ludolph.
 
 See the LICENSE file for copying permission.
 """
+import re
+import sys
+import time
 import logging
 from functools import wraps
+from threading import Lock, Event
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from ordereddict import OrderedDict
 
 LOG_LEVELS = frozenset(['DEBUG', 'INFO', 'WARN', 'WARNING', 'ERROR', 'FATAL', 'CRITICAL'])
 
@@ -42,3 +52,264 @@ def catch_exception(fun):
             logger.exception(e)
             logger.error('Got exception when running %s(%s, %s): %s.', fun.__name__, args, kwargs, e)
     return wrap
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache limited by the total size of stored values (in bytes by default).
+    Items can expire after a specified amount of seconds. A zero max_size disables the cache.
+    """
+    def __init__(self, max_size, sizeof=sys.getsizeof):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # key: (value, size, expires)
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def _pop(self, key):
+        value, size, expires = self._items.pop(key)
+        self.size -= size
+
+        return value
+
+    def get(self, key, default=None):
+        """Return cached value and mark it as recently used"""
+        with self._lock:
+            try:
+                value, size, expires = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires < time.time():
+                self.size -= size
+                self.misses += 1
+                return default
+
+            self._items[key] = (value, size, expires)  # Move to end
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value, ttl=None, size=None):
+        """Store value into cache and remove least recently used items if the cache is full"""
+        if size is None:
+            size = self.sizeof(value)
+
+        if size > self.max_size:
+            return False
+
+        if ttl:
+            expires = time.time() + ttl
+        else:
+            expires = None
+
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+
+            while self._items and self.size + size > self.max_size:
+                self._pop(next(iter(self._items)))
+
+            self._items[key] = (value, size, expires)
+            self.size += size
+
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            try:
+                self._pop(key)
+            except KeyError:
+                return False
+            else:
+                return True
+
+    def invalidate(self, match):
+        """Remove all items with keys matching the match(key) function"""
+        with self._lock:
+            for key in [i for i in self._items if match(i)]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def display_stats(self):
+        """Return cache statistics suitable for logging"""
+        requests = self.hits + self.misses
+
+        if requests:
+            hit_ratio = 100.0 * self.hits / requests
+        else:
+            hit_ratio = 0.0
+
+        return 'items=%d size=%d/%d hits=%d misses=%d hit_ratio=%.1f%%' % (
+            len(self._items), self.size, self.max_size, self.hits, self.misses, hit_ratio)
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key. Only the first call runs and other callers wait for its result.
+    """
+    class _Call(object):
+        def __init__(self):
+            self.event = Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+        self.executed = 0
+        self.collapsed = 0
+
+    def do(self, key, fun, *args, **kwargs):
+        """Run fun(*args, **kwargs) or wait for the result of an already running call with the same key"""
+        with self._lock:
+            call = self._calls.get(key, None)
+
+            if call is None:
+                call = self._calls[key] = self._Call()
+                self.executed += 1
+                leader = True
+            else:
+                self.collapsed += 1
+                leader = False
+
+        if not leader:
+            call.event.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = fun(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call.event.set()
+
+        return call.result
+
+    def display_stats(self):
+        """Return statistics suitable for logging"""
+        return 'in_flight=%d executed=%d collapsed=%d' % (len(self._calls), self.executed, self.collapsed)
+
+
+class CancellationToken(object):
+    """
+    Used for signaling a cancellation request to a running task. The task can poll the cancelled attribute or
+    register callbacks, which will be called upon cancellation.
+    """
+    def __init__(self):
+        self._event = Event()
+        self._callbacks = []
+        self._lock = Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for fun in callbacks:
+            catch_exception(fun)()
+
+    def add_callback(self, fun):
+        """Register function, which will be called upon cancellation (or now if already cancelled)"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fun)
+                return
+
+        catch_exception(fun)()
+
+    def wait(self, timeout=None):
+        """Block until cancelled or timeout occurs. Return True if cancelled"""
+        self._event.wait(timeout)
+
+        return self._event.is_set()
+
+
+class PatternMatcher(object):
+    """
+    Find all regular expressions from a list, which match a text. The patterns are joined into one alternation with
+    named groups, which is scanned with finditer(). One scan is enough if no pattern matches (the common case);
+    otherwise the text is scanned again with the remaining patterns until a scan finds nothing new (overlapping
+    matches of different patterns are not reported by one alternation scan). Patterns, which cannot be combined
+    (backreferences, different flags), are searched separately.
+    """
+    _not_combinable_rx = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+    _group_name = '_pm%d'
+
+    def __init__(self, patterns):
+        """List of compiled regular expressions"""
+        self.patterns = patterns
+        self.combined = None
+        self.indexes = []  # Indexes of patterns in the combined regular expression
+        self.separate = []
+        default_flags = re.compile('').flags
+
+        for i, rx in enumerate(patterns):
+            if rx.flags == default_flags and not self._not_combinable_rx.search(rx.pattern):
+                self.indexes.append(i)
+            else:
+                self.separate.append(i)
+
+        if self.indexes:
+            try:
+                self.combined = self._combine(self.indexes)
+            except re.error as e:  # e.g. the same group name used in two patterns
+                logger.warning('Could not combine regular expressions (%s) - searching them separately', e)
+                self.indexes = []
+                self.separate = list(range(len(patterns)))
+
+    def _combine(self, indexes):
+        return re.compile('|'.join('(?P<%s>%s)' % (self._group_name % i, self.patterns[i].pattern) for i in indexes))
+
+    def match(self, text):
+        """Return list of indexes of patterns matching the text"""
+        res = []
+        remaining = self.indexes
+        rx = self.combined
+
+        while rx:
+            # The outer (pattern) group is always the last closed group of a match
+            found = set(int(m.lastgroup[3:]) for m in rx.finditer(text))
+
+            if not found:
+                break
+
+            res.extend(found)
+            remaining = [i for i in remaining if i not in found]
+
+            if remaining:
+                rx = self._combine(remaining)  # Compiled regular expressions are cached by the re module
+            else:
+                rx = None
+
+        if self.separate:
+            res.extend(i for i in self.separate if self.patterns[i].search(text))
+
+        res.sort()
+
+        return res
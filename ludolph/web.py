@@ -5,12 +5,17 @@ This file is part of Ludolph.
 
 See the LICENSE file for copying permission.
 """
+import os
+import time
 import logging
 import socket
+import tempfile
+from binascii import hexlify
 from functools import wraps
 from collections import namedtuple
+from threading import Lock
 # noinspection PyUnresolvedReferences
-from bottle import Bottle, ServerAdapter, abort, request
+from bottle import Bottle, ServerAdapter, abort, request, response
 
 __all__ = ('webhook', 'request', 'abort')
 
@@ -26,11 +31,155 @@ class LudolphBottle(Bottle):
         return 'ERROR %s: %s\n' % (res.status_code, res.body)
 
 
+class BlobStore(object):
+    """
+    Temporary storage for large command outputs served by the web server. Every blob is accessible through a random
+    token until it expires after ttl seconds; one-time blobs are removed when accessed for the first time. Blobs are
+    kept in memory up to max_memory bytes and saved into temporary files afterwards.
+    """
+    path = '/blob/'
+
+    def __init__(self, max_memory=4194304, ttl=3600):
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.memory = 0
+        self._blobs = {}  # token: (data or None, file path or None, size, expires, once)
+        self._lock = Lock()
+        # Statistics
+        self.stored = 0
+        self.spilled = 0
+        self.served = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._blobs)
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.error('Could not remove blob file "%s": %s', path, e)
+
+    def _pop(self, token):
+        data, path, size, expires, _ = self._blobs.pop(token)
+
+        if data is not None:
+            self.memory -= size
+
+        return data, path, expires
+
+    def _purge(self):
+        now = time.time()
+
+        for token, blob in tuple(self._blobs.items()):  # Copy for python 3
+            if blob[3] < now:
+                _, path, _ = self._pop(token)
+                self.expired += 1
+
+                if path:
+                    self._remove_file(path)
+
+    def add(self, text, once=True):
+        """Store text and return token. A one-time blob is removed after the first access"""
+        data = text.encode('utf-8')
+        size = len(data)
+        token = hexlify(os.urandom(16)).decode('ascii')
+        path = None
+
+        with self._lock:
+            self._purge()
+
+            if self.memory + size > self.max_memory:
+                fd, path = tempfile.mkstemp(prefix='ludolph-blob-')
+
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+
+                data = None
+                self.spilled += 1
+            else:
+                self.memory += size
+
+            self._blobs[token] = (data, path, size, time.time() + self.ttl, once)
+            self.stored += 1
+
+        return token
+
+    def get(self, token):
+        """Return blob data (bytes) or None if the blob does not exist or is expired. One-time blobs are removed"""
+        with self._lock:
+            try:
+                data, path, size, expires, once = self._blobs[token]
+            except KeyError:
+                return None
+
+            expired = expires < time.time()
+
+            if expired:
+                self.expired += 1
+            else:
+                self.served += 1
+
+            if once or expired:
+                self._pop(token)
+            elif path:  # The blob stays in the store
+                with open(path, 'rb') as f:
+                    return f.read()
+            else:
+                return data
+
+        if path:
+            if not expired:
+                with open(path, 'rb') as f:
+                    data = f.read()
+
+            self._remove_file(path)
+
+        if expired:
+            return None
+
+        return data
+
+    def clear(self):
+        with self._lock:
+            for token in tuple(self._blobs.keys()):  # Copy for python 3
+                _, path, _ = self._pop(token)
+
+                if path:
+                    self._remove_file(path)
+
+    def display_stats(self):
+        """Return blob store statistics suitable for logging"""
+        return 'blobs=%d memory=%d/%d stored=%d spilled=%d served=%d expired=%d' % (
+            len(self._blobs), self.memory, self.max_memory, self.stored, self.spilled, self.served, self.expired)
+
+
 WEBAPP = LudolphBottle()
 WEBHOOKS = {}  # {webhook : (name, module, path)}
+BLOBS = BlobStore()
 Webhook = namedtuple('Webhook', ('name', 'module', 'path'))
 
 
+def _blob_view(token):
+    """Serve blob from BLOBS (registered for every WEBAPP)"""
+    data = BLOBS.get(token)
+
+    if data is None:
+        abort(404, 'Not found')
+
+    response.content_type = 'text/plain; charset=utf-8'
+
+    return data
+
+
+def _register_blob_view(app):
+    app.route(BLOBS.path + '<token>', 'GET', _blob_view, name='_blob_view')
+
+
+_register_blob_view(WEBAPP)
+
+
 class WebServer(ServerAdapter):
     """
     Like bottle.WSGIRefServer, but with stop() method.
@@ -38,6 +187,7 @@ class WebServer(ServerAdapter):
     server = None
     quiet = True
     webhooks = WEBHOOKS
+    blobs = BLOBS
 
     def run(self, handler):
         logger.info('Starting web server on http://%s:%s', self.host, self.port)
@@ -101,6 +251,7 @@ class WebServer(ServerAdapter):
             global WEBAPP
             del WEBAPP
             WEBAPP = LudolphBottle()
+            _register_blob_view(WEBAPP)
             self.server.set_app(WEBAPP)
 
     def display_webhooks(self):